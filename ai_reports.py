@@ -1,37 +1,148 @@
 """ИИ-модуль для генерации отчётов через OpenRouter"""
 import httpx
-from typing import Dict, List
+import json
+import re
+from collections import defaultdict
+from typing import AsyncIterator, Dict, List, Tuple
 from loguru import logger
 from config import settings
 from bitrix24_client import Bitrix24Client
+from http_clients import http_clients
+from report_cache import cache_key, get_cached_report, store_report
 from datetime import datetime, timedelta
 
 
+DEAL_FIELDS = ["ID", "TITLE", "STAGE_ID", "OPPORTUNITY", "ASSIGNED_BY_ID", "DATE_CREATE", "CLOSED", "UF_KASPI_PAYMENT"]
+
+# Сколько строк таблицы по товарам передавать модели
+TOP_PRODUCTS = 20
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+
+def parse_period(query: str, now: datetime = None) -> Tuple[datetime, datetime]:
+    """Определить период отчёта по тексту запроса (по умолчанию — последняя неделя)"""
+    now = now or datetime.now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    text = query.lower()
+    
+    if "вчера" in text:
+        return today - timedelta(days=1), today
+    if "сегодня" in text:
+        return today, now
+    
+    match = re.search(r"(\d+)\s*(дн|день|дня|недел|месяц|мес)", text)
+    if match:
+        count = int(match.group(1))
+        unit = match.group(2)
+        days = count * (7 if unit.startswith("недел") else 30 if unit.startswith("мес") else 1)
+        return now - timedelta(days=days), now
+    
+    for word, days in (("квартал", 90), ("полгода", 182), ("год", 365), ("месяц", 30)):
+        if word in text:
+            return now - timedelta(days=days), now
+    return now - timedelta(days=7), now
+
+
+def _amount(value) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def aggregate_deals(
+    deals: List[Dict],
+    product_rows: Dict[str, List[Dict]],
+    stage_names: Dict[str, str],
+    user_names: Dict[str, str]
+) -> Dict[str, List[Tuple]]:
+    """Свести сделки в компактные таблицы: по стадиям, менеджерам, товарам и дням"""
+    by_stage = defaultdict(lambda: [0, 0.0])
+    by_manager = defaultdict(lambda: [0, 0.0, 0])
+    by_day = defaultdict(lambda: [0, 0.0])
+    by_product = defaultdict(lambda: [0.0, 0.0])
+    kaspi = 0
+    
+    for deal in deals:
+        amount = _amount(deal.get("OPPORTUNITY"))
+        stage = stage_names.get(deal.get("STAGE_ID"), deal.get("STAGE_ID") or "—")
+        manager = user_names.get(str(deal.get("ASSIGNED_BY_ID")), str(deal.get("ASSIGNED_BY_ID") or "—"))
+        day = (deal.get("DATE_CREATE") or "")[:10]
+        
+        by_stage[stage][0] += 1
+        by_stage[stage][1] += amount
+        by_manager[manager][0] += 1
+        by_manager[manager][1] += amount
+        if str(deal.get("STAGE_ID", "")).endswith("WON"):
+            by_manager[manager][2] += 1
+        by_day[day][0] += 1
+        by_day[day][1] += amount
+        if deal.get("UF_KASPI_PAYMENT") == "1" or "kaspi" in (deal.get("TITLE") or "").lower():
+            kaspi += 1
+        
+        for row in product_rows.get(str(deal.get("ID")), []):
+            quantity = _amount(row.get("QUANTITY"))
+            by_product[row.get("PRODUCT_NAME") or str(row.get("PRODUCT_ID"))][0] += quantity
+            by_product[row.get("PRODUCT_NAME") or str(row.get("PRODUCT_ID"))][1] += quantity * _amount(row.get("PRICE"))
+    
+    total = sum(_amount(deal.get("OPPORTUNITY")) for deal in deals)
+    return {
+        "Итого (сделок, сумма, средний чек, Kaspi)": [
+            (len(deals), round(total, 2), round(total / len(deals), 2) if deals else 0, kaspi)
+        ],
+        "По стадиям (стадия, сделок, сумма)": sorted(
+            ((name, c, round(s, 2)) for name, (c, s) in by_stage.items()), key=lambda r: -r[2]
+        ),
+        "По менеджерам (менеджер, сделок, сумма, выиграно)": sorted(
+            ((name, c, round(s, 2), won) for name, (c, s, won) in by_manager.items()), key=lambda r: -r[2]
+        ),
+        f"Топ-{TOP_PRODUCTS} товаров (товар, количество, сумма)": sorted(
+            ((name, round(q, 2), round(s, 2)) for name, (q, s) in by_product.items()), key=lambda r: -r[2]
+        )[:TOP_PRODUCTS],
+        "По дням (дата, сделок, сумма)": sorted(
+            (day, c, round(s, 2)) for day, (c, s) in by_day.items()
+        ),
+    }
+
+
+def format_tables(tables: Dict[str, List[Tuple]]) -> str:
+    """Представить таблицы в компактном текстовом виде для промпта"""
+    blocks = []
+    for title, rows in tables.items():
+        lines = [title + ":"] + [" | ".join(str(value) for value in row) for row in rows]
+        if not rows:
+            lines.append("нет данных")
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks)
+
+
 class AIReportsService:
     """Сервис для генерации аналитических отчётов с помощью ИИ"""
     
     def __init__(self):
         self.api_key = settings.openrouter_api_key
         self.model = settings.openrouter_model
-        self.client = httpx.AsyncClient(timeout=60.0)
+        shared = http_clients.get("openrouter")
+        self._owns_client = shared is None
+        self.client = shared or httpx.AsyncClient(timeout=60.0)
         self.bitrix24 = Bitrix24Client()
     
-    async def _call_openrouter(self, messages: List[Dict]) -> str:
-        """Вызов OpenRouter API"""
-        url = "https://openrouter.ai/api/v1/chat/completions"
-        
-        headers = {
+    def _headers(self) -> Dict[str, str]:
+        return {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
-        
+    
+    async def _call_openrouter(self, messages: List[Dict]) -> str:
+        """Вызов OpenRouter API"""
         payload = {
             "model": self.model,
             "messages": messages
         }
         
         try:
-            response = await self.client.post(url, json=payload, headers=headers)
+            response = await self.client.post(OPENROUTER_URL, json=payload, headers=self._headers())
             response.raise_for_status()
             data = response.json()
             return data["choices"][0]["message"]["content"]
@@ -39,17 +150,91 @@ class AIReportsService:
             logger.error(f"Error calling OpenRouter: {e}")
             raise
     
-    async def generate_report(self, query: str) -> str:
-        """Генерация отчёта на основе запроса на естественном языке"""
-        logger.info(f"Generating AI report for query: {query}")
+    async def _stream_openrouter(self, messages: List[Dict]) -> AsyncIterator[str]:
+        """Вызов OpenRouter API в режиме stream: фрагменты ответа по мере генерации"""
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "stream": True
+        }
+        
+        try:
+            async with self.client.stream("POST", OPENROUTER_URL, json=payload, headers=self._headers()) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    # Строки-комментарии (": OPENROUTER PROCESSING") поддерживают соединение
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    if "error" in chunk:
+                        raise Exception(f"OpenRouter error: {chunk['error'].get('message', chunk['error'])}")
+                    for choice in chunk.get("choices") or []:
+                        content = (choice.get("delta") or {}).get("content")
+                        if content:
+                            yield content
+        except Exception as e:
+            logger.error(f"Error streaming from OpenRouter: {e}")
+            raise
+    
+    async def _load_deals(self, date_from: datetime, date_to: datetime) -> List[Dict]:
+        """Сделки Bitrix24, созданные в периоде"""
+        return await self.bitrix24.list_all("crm.deal.list", {
+            "filter": {">=DATE_CREATE": date_from.isoformat(), "<DATE_CREATE": date_to.isoformat()},
+            "select": DEAL_FIELDS,
+            "order": {"ID": "ASC"}
+        }, max_concurrency=settings.bitrix24_max_concurrency)
+    
+    async def _load_product_rows(self, deal_ids: List[str]) -> Dict[str, List[Dict]]:
+        """Товарные строки сделок через batch"""
+        batch = await self.bitrix24.call_batch(
+            {f"d{deal_id}": ("crm.deal.productrows.get", {"id": deal_id}) for deal_id in deal_ids},
+            max_concurrency=settings.bitrix24_max_concurrency
+        )
+        if batch["errors"]:
+            logger.warning(f"Failed to load product rows for {len(batch['errors'])} deals")
+        return {key[1:]: rows for key, rows in batch["result"].items() if isinstance(rows, list)}
+    
+    async def _load_names(self, manager_ids: List[str]) -> Tuple[Dict[str, str], Dict[str, str]]:
+        """Названия стадий и имена менеджеров"""
+        commands = {"stages": ("crm.status.list", {"filter": {"ENTITY_ID": "DEAL_STAGE"}})}
+        commands.update({f"u{user_id}": ("user.get", {"ID": user_id}) for user_id in manager_ids})
+        batch = await self.bitrix24.call_batch(commands)
+        
+        stage_names = {
+            stage.get("STATUS_ID"): stage.get("NAME")
+            for stage in batch["result"].get("stages") or []
+        }
+        user_names = {}
+        for key, users in batch["result"].items():
+            if key.startswith("u") and users:
+                user = users[0]
+                user_names[key[1:]] = f"{user.get('NAME', '')} {user.get('LAST_NAME', '')}".strip() or key[1:]
+        return stage_names, user_names
+    
+    async def collect_summary(self, date_from: datetime, date_to: datetime) -> str:
+        """Выгрузить сделки за период и свести их в таблицы для промпта"""
+        deals = await self._load_deals(date_from, date_to)
+        logger.info(f"Loaded {len(deals)} deals for AI report")
         
-        # Определяем временной диапазон (по умолчанию - последняя неделя)
-        date_to = datetime.now()
-        date_from = date_to - timedelta(days=7)
+        deal_ids = [str(deal["ID"]) for deal in deals if deal.get("ID")]
+        manager_ids = sorted({str(deal["ASSIGNED_BY_ID"]) for deal in deals if deal.get("ASSIGNED_BY_ID")})
+        product_rows = await self._load_product_rows(deal_ids) if deal_ids else {}
+        stage_names, user_names = await self._load_names(manager_ids)
+        
+        return format_tables(aggregate_deals(deals, product_rows, stage_names, user_names))
+    
+    async def _build_messages(self, query: str, date_from: datetime, date_to: datetime) -> List[Dict]:
+        """Сообщения для модели со сводкой сделок за период"""
+        summary = await self.collect_summary(date_from, date_to)
         
         # Формируем контекст для ИИ
         context = f"""
-У тебя есть данные о сделках из CRM системы Bitrix24 за период с {date_from.strftime('%d.%m.%Y')} по {date_to.strftime('%d.%m.%Y')}.
+Ниже сводные данные о сделках из CRM системы Bitrix24 за период с {date_from.strftime('%d.%m.%Y')} по {date_to.strftime('%d.%m.%Y')}.
+
+{summary}
 
 Пользователь задал вопрос: "{query}"
 
@@ -58,10 +243,10 @@ class AIReportsService:
 2. Статистику и цифры
 3. Выводы и рекомендации (если применимо)
 
-Форматируй ответ в читаемом виде.
+Используй только приведённые цифры. Форматируй ответ в читаемом виде.
 """
         
-        messages = [
+        return [
             {
                 "role": "system",
                 "content": "Ты - аналитик данных, специализирующийся на анализе продаж. Предоставляй точные, структурированные отчёты."
@@ -71,14 +256,52 @@ class AIReportsService:
                 "content": context
             }
         ]
+    
+    async def generate_report(self, query: str) -> str:
+        """Генерация отчёта на основе запроса на естественном языке"""
+        logger.info(f"Generating AI report for query: {query}")
+        
+        date_from, date_to = parse_period(query)
+        key = cache_key(query, self.model, date_from, date_to)
+        cached = await get_cached_report(key)
+        if cached is not None:
+            logger.info("AI report served from cache")
+            return cached
+        
+        messages = await self._build_messages(query, date_from, date_to)
         
         # Получаем ответ от ИИ
         report = await self._call_openrouter(messages)
         logger.info("AI report generated successfully")
         
+        await store_report(key, query, self.model, date_from, date_to, report)
         return report
     
+    async def stream_report(self, query: str) -> AsyncIterator[str]:
+        """Генерация отчёта с выдачей текста по мере ответа модели"""
+        logger.info(f"Streaming AI report for query: {query}")
+        
+        date_from, date_to = parse_period(query)
+        key = cache_key(query, self.model, date_from, date_to)
+        cached = await get_cached_report(key)
+        if cached is not None:
+            logger.info("AI report served from cache")
+            yield cached
+            return
+        
+        messages = await self._build_messages(query, date_from, date_to)
+        
+        parts = []
+        async for content in self._stream_openrouter(messages):
+            parts.append(content)
+            yield content
+        logger.info("AI report streamed successfully")
+        
+        # В кэш попадает только полностью полученный ответ
+        await store_report(key, query, self.model, date_from, date_to, "".join(parts))
+    
     async def close(self):
         """Закрыть HTTP клиенты"""
-        await self.client.aclose()
+        if self._owns_client:
+            await self.client.aclose()
         await self.bitrix24.close()
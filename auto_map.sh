@@ -58,14 +58,9 @@ print(f'\n✅ Сопоставлено: {matched}/{len(b24)}\n')
 PYEOF
 
 echo "💾 Загрузка в БД..."
-tail -n +2 mapping.csv | while IFS=',' read -r id name code onec; do
-    id=$(echo $id | tr -d '"'); code=$(echo $code | tr -d '"')
-    name=$(echo $name | tr -d '"'); onec=$(echo $onec | tr -d '"')
-    curl -s -X POST https://bizdnai.com/morozov/api/mapping/product \
-      -H "Content-Type: application/json" \
-      -d "{\"bitrix24_product_id\":\"$id\",\"bitrix24_product_name\":\"$name\",\"onec_product_code\":\"$code\",\"onec_product_name\":\"$onec\"}" \
-      >/dev/null && echo "✅ $id → $code"
-done
+curl -s -X POST https://bizdnai.com/morozov/api/mapping/products/bulk \
+  -F "file=@mapping.csv;type=text/csv"
+echo ""
 
 echo ""
 echo "✅ ГОТОВО! Проверить: curl https://bizdnai.com/morozov/api/mapping/products"
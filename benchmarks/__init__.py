@@ -0,0 +1 @@
+"""Бенчмарк интеграции на локальных заглушках 1С OData и Bitrix24"""
@@ -0,0 +1,310 @@
+"""ASGI-заглушки 1С OData и Bitrix24 REST для бенчмарка
+
+Отвечают в тех же форматах, что и настоящие сервисы (Atom XML у 1С,
+JSON и batch у Bitrix24), с настраиваемой задержкой и ограничениями:
+пул соединений публикации 1С и лимит запросов в секунду у Bitrix24.
+"""
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from dataclasses import dataclass, field
+from html import escape
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, unquote
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+
+SEED_DIR = Path(__file__).resolve().parent.parent
+
+ATOM_NS = (
+    'xmlns="http://www.w3.org/2005/Atom" '
+    'xmlns:d="http://schemas.microsoft.com/ado/2007/08/dataservices" '
+    'xmlns:m="http://schemas.microsoft.com/ado/2007/08/dataservices/metadata"'
+)
+NDS_KEY = "156d4f18-4e45-11ea-8d1d-84a93e69ebd9"
+
+
+@dataclass
+class CatalogItem:
+    """Товар, одинаково известный обеим заглушкам"""
+    code: str
+    ref_key: str
+    onec_name: str
+    bitrix24_id: str
+    bitrix24_name: str
+    quantity: int
+
+
+def load_seed_names(seed_dir: Path = SEED_DIR) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """Товары Bitrix24 из b24_p1.json/b24_p2.json и названия номенклатуры из 1c_nomenclature.txt"""
+    bitrix24 = []
+    for name in ("b24_p1.json", "b24_p2.json"):
+        with open(seed_dir / name, encoding="utf-8") as f:
+            bitrix24.extend((str(p["ID"]), p["NAME"]) for p in json.load(f)["result"])
+    with open(seed_dir / "1c_nomenclature.txt", encoding="utf-8") as f:
+        onec = [line.strip() for line in f if line.strip()]
+    return bitrix24, onec
+
+
+def build_catalog(size: int, seed_dir: Path = SEED_DIR) -> List[CatalogItem]:
+    """Каталог из size товаров: реальные названия, размноженные суффиксом"""
+    bitrix24, onec = load_seed_names(seed_dir)
+    rng = random.Random(size)
+    max_seed_id = max(int(product_id) for product_id, _ in bitrix24)
+    items = []
+    for i in range(size):
+        round_, pos = divmod(i, len(bitrix24))
+        product_id, bitrix24_name = bitrix24[pos]
+        onec_name = onec[i % len(onec)]
+        if round_:
+            product_id = str(max_seed_id + i)
+            bitrix24_name = f"{bitrix24_name} #{round_}"
+            onec_name = f"{onec_name} #{i // len(onec)}"
+        items.append(CatalogItem(
+            code=f"00-{i + 1:08d}",
+            ref_key=str(uuid.uuid5(uuid.NAMESPACE_URL, f"bench-nomenclature-{i}")),
+            onec_name=onec_name,
+            bitrix24_id=product_id,
+            bitrix24_name=bitrix24_name,
+            quantity=rng.randint(0, 500)
+        ))
+    return items
+
+
+class Catalog:
+    """Общий каталог заглушек; заменяется между прогонами"""
+    
+    def __init__(self, items: List[CatalogItem]):
+        self.replace(items)
+    
+    def replace(self, items: List[CatalogItem]):
+        self.items = sorted(items, key=lambda item: item.ref_key)
+        self.by_code = {item.code: item for item in items}
+        self.by_ref = {item.ref_key: item for item in items}
+        self.by_bitrix24 = {item.bitrix24_id: item for item in items}
+
+
+@dataclass
+class UpstreamStats:
+    requests: int = 0
+    rejected: int = 0
+    by_method: Dict[str, int] = field(default_factory=dict)
+    
+    def count(self, method: str):
+        self.requests += 1
+        self.by_method[method] = self.by_method.get(method, 0) + 1
+    
+    def as_dict(self) -> Dict:
+        return {"requests": self.requests, "rejected": self.rejected, "by_method": dict(self.by_method)}
+
+
+def _feed(entries: List[Dict[str, Any]]) -> str:
+    body = "".join(
+        "<entry><content type=\"application/xml\"><m:properties>"
+        + "".join(f"<d:{name}>{escape(str(value), quote=False)}</d:{name}>" for name, value in props.items())
+        + "</m:properties></content></entry>"
+        for props in entries
+    )
+    return f'<?xml version="1.0" encoding="UTF-8"?><feed {ATOM_NS}>{body}</feed>'
+
+
+def _created(entity: str, ref_key: str, props: Dict[str, Any]) -> str:
+    properties = "".join(f"<d:{name}>{escape(str(value), quote=False)}</d:{name}>" for name, value in props.items())
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?><entry {ATOM_NS}>'
+        f"<id>http://onec/odata/standard.odata/{entity}(guid'{ref_key}')</id>"
+        f'<content type="application/xml"><m:properties><d:Ref_Key>{ref_key}</d:Ref_Key>{properties}</m:properties></content></entry>'
+    )
+
+
+class FakeOneC:
+    """Заглушка публикации 1С: справочники, остатки и создание документов"""
+    
+    def __init__(self, catalog: Catalog, latency: float = 0.05, row_latency: float = 0.0001, pool_size: int = 10):
+        self.catalog = catalog
+        self.latency = latency
+        self.row_latency = row_latency
+        self.pool = asyncio.Semaphore(pool_size)
+        self.stats = UpstreamStats()
+        # ID сделки -> момент создания документа (time.perf_counter)
+        self.documents: Dict[str, float] = {}
+        self._document_number = 0
+        self.app = FastAPI()
+        self.app.add_api_route("/{path:path}", self.handle, methods=["GET", "POST"])
+    
+    async def handle(self, path: str, request: Request) -> Response:
+        entity = unquote(path).split("standard.odata/", 1)[-1]
+        self.stats.count(re.sub(r"\(.*?\)", "", entity))
+        async with self.pool:
+            if request.method == "POST":
+                await asyncio.sleep(self.latency)
+                return self._create(entity, (await request.body()).decode("utf-8"))
+            
+            query = dict(parse_qsl(request.url.query))
+            rows = self._select(entity, query)
+            await asyncio.sleep(self.latency + self.row_latency * len(rows))
+            return Response(_feed(rows), media_type="application/atom+xml")
+    
+    def _page(self, items: list, query: Dict[str, str]) -> list:
+        skip = int(query.get("$skip", 0))
+        top = int(query.get("$top", len(items)))
+        return items[skip:skip + top]
+    
+    def _select(self, entity: str, query: Dict[str, str]) -> List[Dict]:
+        filter_expr = query.get("$filter", "")
+        if entity.startswith("Catalog_Номенклатура"):
+            if "Code eq" in filter_expr:
+                codes = [code.replace("''", "'") for code in re.findall(r"Code eq '((?:[^']|'')*)'", filter_expr)]
+                items = [self.catalog.by_code[code] for code in codes if code in self.catalog.by_code]
+            elif "Ref_Key eq" in filter_expr:
+                refs = re.findall(r"Ref_Key eq guid'([^']+)'", filter_expr)
+                items = [self.catalog.by_ref[ref] for ref in refs if ref in self.catalog.by_ref]
+            else:
+                items = self._page(self.catalog.items, query)
+            return [
+                {"Ref_Key": item.ref_key, "Code": item.code, "Description": item.onec_name, "СтавкаНДС_Key": NDS_KEY}
+                for item in items
+            ]
+        if entity.startswith("AccumulationRegister_") and "/Balance" in entity:
+            # Как и 1С, Balance не возвращает товары с нулевым остатком
+            return [
+                {"Товар_Key": item.ref_key, "КоличествоBalance": item.quantity}
+                for item in self._page([item for item in self.catalog.items if item.quantity], query)
+            ]
+        # Контрагенты: поиск по телефону ничего не находит, новые создаются POST-запросом
+        return []
+    
+    def _create(self, entity: str, body: str) -> Response:
+        ref_key = str(uuid.uuid4())
+        if entity.startswith("Document_"):
+            self._document_number += 1
+            number = f"БН-{self._document_number:08d}"
+            match = re.search(r"Bitrix24 сделка (\S+):", body)
+            if match:
+                self.documents[match.group(1)] = time.perf_counter()
+            return Response(_created(entity, ref_key, {"Number": number}), status_code=201, media_type="application/atom+xml")
+        return Response(_created(entity, ref_key, {}), status_code=201, media_type="application/atom+xml")
+
+
+class FakeBitrix24:
+    """Заглушка REST Bitrix24 (входящий вебхук) с batch и лимитом запросов"""
+    
+    def __init__(self, catalog: Catalog, latency: float = 0.1, command_latency: float = 0.002, rps: float = 0, burst: int = 50):
+        self.catalog = catalog
+        self.latency = latency
+        self.command_latency = command_latency
+        self.rps = rps
+        self.burst = burst
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self.stats = UpstreamStats()
+        self.quantities: Dict[str, int] = {}
+        self.app = FastAPI()
+        self.app.add_api_route("/{path:path}", self.handle, methods=["GET", "POST"])
+    
+    def _take_token(self) -> bool:
+        """Маркерная корзина: rps запросов в секунду, не больше burst подряд"""
+        if not self.rps:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rps)
+        self._refilled_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+    
+    async def handle(self, path: str, request: Request) -> Response:
+        method = path.rstrip("/").rsplit("/", 1)[-1]
+        self.stats.count(method)
+        if not self._take_token():
+            self.stats.rejected += 1
+            return JSONResponse(
+                {"error": "QUERY_LIMIT_EXCEEDED", "error_description": "Too many requests"},
+                status_code=503
+            )
+        
+        body = await request.body()
+        params = json.loads(body) if body else {}
+        
+        if method == "batch":
+            commands = params.get("cmd") or {}
+            await asyncio.sleep(self.latency + self.command_latency * len(commands))
+            return JSONResponse({"result": self._batch(commands, bool(params.get("halt")))})
+        
+        await asyncio.sleep(self.latency)
+        try:
+            return JSONResponse({"result": self._call(method, params)})
+        except LookupError as e:
+            return JSONResponse({"error": "NOT_FOUND", "error_description": str(e)}, status_code=400)
+    
+    def _batch(self, commands: Dict[str, str], halt: bool) -> Dict:
+        results: Dict[str, Any] = {}
+        errors: Dict[str, Any] = {}
+        for key, command in commands.items():
+            method, _, query = command.partition("?")
+            params = {}
+            for name, value in parse_qsl(query, keep_blank_values=True):
+                reference = re.fullmatch(r"\$result\[(\w+)\]\[(\w+)\]", value)
+                if reference:
+                    value = (results.get(reference.group(1)) or {}).get(reference.group(2), "")
+                params[name] = value
+            try:
+                results[key] = self._call(method, params)
+            except LookupError as e:
+                errors[key] = {"error": "NOT_FOUND", "error_description": str(e)}
+                if halt:
+                    break
+        return {"result": results, "result_error": errors, "result_total": [], "result_next": []}
+    
+    def _deal_products(self, deal_id: str) -> List[Dict]:
+        rng = random.Random(deal_id)
+        items = rng.sample(self.catalog.items, min(len(self.catalog.items), rng.randint(1, 3)))
+        return [
+            {
+                "PRODUCT_ID": item.bitrix24_id,
+                "PRODUCT_NAME": item.bitrix24_name,
+                "QUANTITY": rng.randint(1, 3),
+                "PRICE": rng.randint(10, 300) * 100
+            }
+            for item in items
+        ]
+    
+    def _call(self, method: str, params: Dict) -> Any:
+        object_id = str(params.get("id") or params.get("ID") or "")
+        if method == "crm.deal.get":
+            amount = sum(row["QUANTITY"] * row["PRICE"] for row in self._deal_products(object_id))
+            return {
+                "ID": object_id,
+                "TITLE": f"Kaspi заказ {object_id}",
+                "STAGE_ID": "NEW",
+                "OPPORTUNITY": str(amount),
+                "CONTACT_ID": object_id,
+                "UF_KASPI_PAYMENT": "1"
+            }
+        if method == "crm.deal.productrows.get":
+            return self._deal_products(object_id)
+        if method == "crm.contact.get":
+            if not object_id:
+                raise LookupError("ID is not defined or invalid")
+            return {
+                "ID": object_id,
+                "NAME": "Покупатель",
+                "LAST_NAME": object_id,
+                "PHONE": [{"VALUE": f"+7700{int(object_id) % 10_000_000:07d}", "VALUE_TYPE": "MOBILE"}]
+            }
+        if method == "catalog.product.update":
+            # В batch параметры приходят развёрнутыми (fields[quantity]), в прямом вызове — JSON
+            quantity = params.get("fields[quantity]", (params.get("fields") or {}).get("quantity"))
+            self.quantities[object_id] = int(quantity)
+            return {"element": {"id": object_id}}
+        if method in ("crm.deal.update", "profile"):
+            return True
+        if method == "crm.activity.add":
+            return random.randint(1, 10 ** 6)
+        raise LookupError(f"Method {method} is not supported by the benchmark stub")
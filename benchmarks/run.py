@@ -0,0 +1,237 @@
+"""Бенчмарк пропускной способности интеграции
+
+Запускает приложение целиком (lifespan, воркеры очереди, индексы) против
+локальных заглушек 1С и Bitrix24 и измеряет:
+- задержку вебхук -> документ в 1С (перцентили) и число сделок в секунду;
+- время полной синхронизации остатков на каталогах разного размера.
+
+Нужна отдельная, не рабочая, база PostgreSQL: бенчмарк создаёт в ней
+маппинг товаров, задачи, документы и снимки остатков.
+
+    BENCH_DATABASE_URL=postgresql://... python -m benchmarks.run --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List
+
+
+BENCH_ENV = {
+    "BITRIX24_WEBHOOK_URL": "http://bitrix24.bench/rest/1/bench/",
+    "BITRIX24_DOMAIN": "bitrix24.bench",
+    "ONEC_BASE_URL": "http://onec.bench/base",
+    "ONEC_USERNAME": "bench",
+    "ONEC_PASSWORD": "bench",
+    "OPENROUTER_API_KEY": "bench",
+    "TELEGRAM_BOT_TOKEN": "",
+    "TELEGRAM_CHAT_ID": "",
+}
+
+# Можно переопределить переменными окружения
+BENCH_DEFAULTS = {
+    "LOG_LEVEL": "WARNING",
+    "DEAL_DEBOUNCE_SECONDS": "0",
+    "DEAL_JOB_POLL_INTERVAL": "0.1",
+    "STOCK_INCREMENTAL_INTERVAL": "0",
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--label", default=None, help="Метка версии в результатах (по умолчанию git describe)")
+    parser.add_argument("--output", default=None, help="Файл для JSON с результатами (по умолчанию stdout)")
+    parser.add_argument("--skus", default="1000,10000,100000", help="Размеры каталога для синхронизации остатков")
+    parser.add_argument("--deals", type=int, default=200, help="Число сделок в прогоне вебхуков")
+    parser.add_argument("--deal-rate", type=float, default=0, help="Вебхуков в секунду (0 — все сразу)")
+    parser.add_argument("--deal-timeout", type=float, default=300, help="Сколько ждать создания всех документов, с")
+    parser.add_argument("--onec-latency", type=float, default=0.05, help="Задержка ответа 1С, с")
+    parser.add_argument("--onec-row-latency", type=float, default=0.0001, help="Доп. задержка 1С на строку ответа, с")
+    parser.add_argument("--onec-pool", type=int, default=10, help="Пул соединений публикации 1С")
+    parser.add_argument("--bitrix-latency", type=float, default=0.1, help="Задержка ответа Bitrix24, с")
+    parser.add_argument("--bitrix-command-latency", type=float, default=0.002, help="Доп. задержка на команду batch, с")
+    parser.add_argument("--bitrix-rps", type=float, default=0, help="Лимит запросов Bitrix24 в секунду (0 — без лимита)")
+    parser.add_argument("--bitrix-burst", type=int, default=50, help="Запас запросов Bitrix24 сверх лимита")
+    return parser.parse_args()
+
+
+def git_label() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """Перцентили по методу ближайшего ранга"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    
+    def rank(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))], 4)
+    
+    return {"p50": rank(50), "p90": rank(90), "p95": rank(95), "p99": rank(99), "max": round(ordered[-1], 4)}
+
+
+async def seed_mappings(items) -> int:
+    """Записать маппинг товаров каталога в базу и перечитать индекс"""
+    from config import settings
+    from database import async_session_maker
+    from mapping_import import upsert_mappings
+    from mapping_index import mapping_index
+    
+    rows = [
+        {
+            "bitrix24_product_id": item.bitrix24_id,
+            "bitrix24_product_name": item.bitrix24_name[:500],
+            "onec_product_code": item.code,
+            "onec_product_name": item.onec_name[:500]
+        }
+        for item in items
+    ]
+    chunk_size = settings.mapping_import_chunk_size
+    async with async_session_maker() as session:
+        for start in range(0, len(rows), chunk_size):
+            await upsert_mappings(session, rows[start:start + chunk_size])
+        await session.commit()
+    await mapping_index.load()
+    return len(rows)
+
+
+async def bench_deals(args, fake_onec) -> Dict:
+    """Вебхуки сделок через ASGI приложения до создания документов в 1С"""
+    import httpx
+    import server
+    
+    base_id = int(time.time()) * 1000
+    deal_ids = [str(base_id + i) for i in range(args.deals)]
+    sent_at: Dict[str, float] = {}
+    interval = 1 / args.deal_rate if args.deal_rate else 0
+    
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://middleware") as client:
+        started = time.perf_counter()
+        for deal_id in deal_ids:
+            sent_at[deal_id] = time.perf_counter()
+            response = await client.post("/webhook/bitrix24/deal", data={
+                "event": "ONCRMDEALADD",
+                "data[FIELDS][ID]": deal_id
+            })
+            response.raise_for_status()
+            if interval:
+                await asyncio.sleep(interval)
+        sent = time.perf_counter() - started
+    
+    deadline = time.perf_counter() + args.deal_timeout
+    while time.perf_counter() < deadline and not all(deal_id in fake_onec.documents for deal_id in deal_ids):
+        await asyncio.sleep(0.05)
+    
+    done = [deal_id for deal_id in deal_ids if deal_id in fake_onec.documents]
+    latencies = [fake_onec.documents[deal_id] - sent_at[deal_id] for deal_id in done]
+    elapsed = (max(fake_onec.documents[deal_id] for deal_id in done) - started) if done else 0
+    return {
+        "deals": len(deal_ids),
+        "completed": len(done),
+        "webhooks_sent_seconds": round(sent, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "deals_per_second": round(len(done) / elapsed, 2) if elapsed else 0,
+        "webhook_to_document_seconds": percentiles(latencies)
+    }
+
+
+async def bench_stock(size: int, catalog, fake_onec, fake_bitrix24) -> Dict:
+    """Полная синхронизация остатков на каталоге из size товаров"""
+    from benchmarks.fakes import build_catalog
+    from nomenclature_index import nomenclature_index
+    from onec_client import refresh_nomenclature_index
+    from sync_service import SyncService
+    
+    items = build_catalog(size)
+    catalog.replace(items)
+    await seed_mappings(items)
+    
+    nomenclature_index.invalidate()
+    refresh_before = fake_onec.stats.requests
+    started = time.perf_counter()
+    await refresh_nomenclature_index()
+    refresh_seconds = time.perf_counter() - started
+    refresh_requests = fake_onec.stats.requests - refresh_before
+    
+    fake_bitrix24.quantities.clear()
+    onec_before, bitrix24_before = fake_onec.stats.requests, fake_bitrix24.stats.requests
+    rejected_before = fake_bitrix24.stats.rejected
+    sync_service = SyncService()
+    started = time.perf_counter()
+    await sync_service.sync_stock_to_bitrix24(delta=False)
+    sync_seconds = time.perf_counter() - started
+    
+    return {
+        "skus": size,
+        "nomenclature_refresh_seconds": round(refresh_seconds, 3),
+        "nomenclature_refresh_requests": refresh_requests,
+        "nomenclature_index_size": len(nomenclature_index),
+        "sync_seconds": round(sync_seconds, 3),
+        "items_per_second": round(size / sync_seconds, 1) if sync_seconds else 0,
+        "products_updated": len(fake_bitrix24.quantities),
+        "onec_requests": fake_onec.stats.requests - onec_before,
+        "bitrix24_requests": fake_bitrix24.stats.requests - bitrix24_before,
+        "bitrix24_rejected": fake_bitrix24.stats.rejected - rejected_before
+    }
+
+
+async def main(args) -> Dict:
+    from benchmarks.fakes import Catalog, FakeBitrix24, FakeOneC, build_catalog
+    import httpx
+    import server
+    from http_clients import http_clients
+    
+    sizes = [int(size) for size in args.skus.split(",") if size.strip()]
+    catalog = Catalog(build_catalog(min(sizes) if sizes else 1000))
+    fake_onec = FakeOneC(catalog, args.onec_latency, args.onec_row_latency, args.onec_pool)
+    fake_bitrix24 = FakeBitrix24(catalog, args.bitrix_latency, args.bitrix_command_latency, args.bitrix_rps, args.bitrix_burst)
+    
+    # Пулы с заглушками создаются до lifespan, повторный start в lifespan ничего не делает
+    await http_clients.start(transports={
+        "onec": httpx.ASGITransport(app=fake_onec.app),
+        "bitrix24": httpx.ASGITransport(app=fake_bitrix24.app)
+    })
+    
+    results = {
+        "label": args.label or git_label(),
+        "started_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "python": sys.version.split()[0],
+        "config": {key: value for key, value in vars(args).items() if key not in ("label", "output")},
+    }
+    async with server.app.router.lifespan_context(server.app):
+        await seed_mappings(catalog.items)
+        results["deal_webhooks"] = await bench_deals(args, fake_onec)
+        results["stock_sync"] = [await bench_stock(size, catalog, fake_onec, fake_bitrix24) for size in sizes]
+    
+    results["upstream_requests"] = {"onec": fake_onec.stats.as_dict(), "bitrix24": fake_bitrix24.stats.as_dict()}
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not os.environ.get("BENCH_DATABASE_URL"):
+        sys.exit("BENCH_DATABASE_URL is required: the benchmark writes mappings, jobs and snapshots to this database")
+    os.environ.update(BENCH_ENV)
+    os.environ["DATABASE_URL"] = os.environ["BENCH_DATABASE_URL"]
+    for key, value in BENCH_DEFAULTS.items():
+        os.environ.setdefault(key, value)
+    
+    results = asyncio.run(main(args))
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -1,49 +1,229 @@
 """Клиент для работы с Bitrix24 REST API"""
+import asyncio
+import hashlib
 import httpx
-from typing import Dict, List, Optional, Any
+import json
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Any, Tuple
+from urllib.parse import urlencode
 from loguru import logger
 from config import settings
+from http_clients import http_clients
+
+
+def _flatten_params(params: Any, prefix: str = "") -> List[Tuple[str, str]]:
+    """Развернуть вложенные параметры в формат PHP http_build_query"""
+    if isinstance(params, dict):
+        items = params.items()
+    elif isinstance(params, (list, tuple)):
+        items = enumerate(params)
+    else:
+        return [(prefix, "" if params is None else str(params))]
+    
+    pairs = []
+    for key, value in items:
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        pairs.extend(_flatten_params(value, name))
+    return pairs
+
+
+class Bitrix24Error(Exception):
+    """Ошибка REST API Bitrix24 (code — код ошибки, например QUERY_LIMIT_EXCEEDED)"""
+    
+    def __init__(self, code: str, description: str):
+        super().__init__(f"Bitrix24 API error: {description}")
+        self.code = code
+
+
+@dataclass
+class DealDetails:
+    """Сделка вместе с товарами и контактом"""
+    deal: Dict
+    products: List[Dict] = field(default_factory=list)
+    contact: Dict = field(default_factory=dict)
+    
+    @property
+    def is_kaspi(self) -> bool:
+        return self.deal.get("UF_KASPI_PAYMENT") == "1" or "kaspi" in self.deal.get("TITLE", "").lower()
+    
+    @property
+    def customer_name(self) -> str:
+        return (self.contact.get("NAME", "") + " " + self.contact.get("LAST_NAME", "")).strip()
+    
+    @property
+    def customer_phone(self) -> str:
+        return self.contact.get("PHONE", [{}])[0].get("VALUE", "") if self.contact.get("PHONE") else ""
+    
+    @property
+    def content_hash(self) -> str:
+        """Хэш состава товаров и суммы сделки"""
+        rows = sorted(
+            (str(p.get("PRODUCT_ID")), str(p.get("QUANTITY")), str(p.get("PRICE")))
+            for p in self.products
+        )
+        payload = json.dumps({"products": rows, "amount": str(self.deal.get("OPPORTUNITY"))})
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
 
 class Bitrix24Client:
     """Клиент для взаимодействия с Bitrix24"""
     
+    # Максимум команд в одном вызове batch
+    BATCH_LIMIT = 50
+    # Размер страницы списочных методов
+    LIST_PAGE_SIZE = 50
+    
     def __init__(self):
         self.webhook_url = settings.bitrix24_webhook_url.rstrip('/')
-        self.client = httpx.AsyncClient(timeout=30.0)
+        shared = http_clients.get("bitrix24")
+        self._owns_client = shared is None
+        self.client = shared or httpx.AsyncClient(timeout=30.0)
     
-    async def _call_method(self, method: str, params: Dict = None) -> Dict:
-        """Вызов метода REST API Bitrix24"""
+    async def _request(self, method: str, params: Dict = None) -> Dict:
+        """Вызов метода REST API Bitrix24, полный ответ (result, total, next)"""
         url = f"{self.webhook_url}/{method}"
         try:
             response = await self.client.post(url, json=params or {})
-            response.raise_for_status()
-            data = response.json()
+            try:
+                data = response.json()
+            except ValueError:
+                response.raise_for_status()
+                raise
             
+            # Ошибки API приходят в теле и с кодом 4xx/5xx (QUERY_LIMIT_EXCEEDED — 503)
             if "error" in data:
-                logger.error(f"Bitrix24 API error: {data['error_description']}")
-                raise Exception(f"Bitrix24 API error: {data['error_description']}")
+                description = data.get("error_description") or data["error"]
+                logger.error(f"Bitrix24 API error: {description}")
+                raise Bitrix24Error(data["error"], description)
             
-            return data.get("result", {})
+            response.raise_for_status()
+            return data
         except httpx.HTTPError as e:
             logger.error(f"HTTP error calling Bitrix24: {e}")
             raise
     
-    async def get_deal(self, deal_id: str) -> Dict:
-        """Получить данные сделки"""
-        logger.info(f"Getting deal {deal_id} from Bitrix24")
-        return await self._call_method("crm.deal.get", {"id": deal_id})
+    async def _call_method(self, method: str, params: Dict = None) -> Dict:
+        """Вызов метода REST API Bitrix24"""
+        data = await self._request(method, params)
+        return data.get("result", {})
+    
+    async def _call_batch_chunk(self, commands: Dict[str, Tuple[str, Dict]], halt: bool) -> Tuple[Dict[str, Any], Dict[str, str]]:
+        """Один вызов batch (не больше BATCH_LIMIT команд)"""
+        cmd = {
+            # $result[...] — ссылки на результаты предыдущих команд, не кодируются
+            key: f"{method}?{urlencode(_flatten_params(params or {}), safe='[]$')}"
+            for key, (method, params) in commands.items()
+        }
+        try:
+            data = await self._call_method("batch", {"halt": 1 if halt else 0, "cmd": cmd})
+        except Exception as e:
+            logger.error(f"Bitrix24 batch call failed: {e}")
+            return {}, {key: str(e) for key in commands}
+        
+        results: Dict[str, Any] = {}
+        errors: Dict[str, str] = {}
+        chunk_results = data.get("result") or {}
+        chunk_errors = data.get("result_error") or {}
+        for key in commands:
+            if key in chunk_errors:
+                error = chunk_errors[key]
+                errors[key] = error.get("error_description", str(error)) if isinstance(error, dict) else str(error)
+            elif key in chunk_results:
+                results[key] = chunk_results[key]
+            else:
+                errors[key] = "No result returned"
+        return results, errors
     
-    async def get_deal_products(self, deal_id: str) -> List[Dict]:
-        """Получить товары из сделки"""
-        logger.info(f"Getting products for deal {deal_id}")
-        result = await self._call_method("crm.deal.productrows.get", {"id": deal_id})
-        return result if isinstance(result, list) else []
+    async def call_batch(self, commands: Dict[str, Tuple[str, Dict]], halt: bool = False, max_concurrency: int = 1) -> Dict:
+        """Выполнить команды через метод batch (по BATCH_LIMIT за вызов)
+        
+        commands: {ключ: (метод, параметры)}.
+        Возвращает {"result": {ключ: результат}, "errors": {ключ: описание ошибки}}.
+        При halt=True пачки выполняются строго по очереди до первой ошибки.
+        """
+        keys = list(commands)
+        chunks = [
+            {key: commands[key] for key in keys[start:start + self.BATCH_LIMIT]}
+            for start in range(0, len(keys), self.BATCH_LIMIT)
+        ]
+        results: Dict[str, Any] = {}
+        errors: Dict[str, str] = {}
+        
+        if halt or max_concurrency <= 1:
+            for chunk in chunks:
+                chunk_results, chunk_errors = await self._call_batch_chunk(chunk, halt)
+                results.update(chunk_results)
+                errors.update(chunk_errors)
+                if halt and chunk_errors:
+                    break
+        else:
+            semaphore = asyncio.Semaphore(max_concurrency)
+            
+            async def _run(chunk):
+                async with semaphore:
+                    return await self._call_batch_chunk(chunk, halt)
+            
+            for chunk_results, chunk_errors in await asyncio.gather(*(_run(chunk) for chunk in chunks)):
+                results.update(chunk_results)
+                errors.update(chunk_errors)
+        
+        return {"result": results, "errors": errors}
     
-    async def get_contact(self, contact_id: str) -> Dict:
-        """Получить данные контакта"""
-        logger.info(f"Getting contact {contact_id}")
-        return await self._call_method("crm.contact.get", {"id": contact_id})
+    async def list_all(self, method: str, params: Dict = None, max_concurrency: int = 2) -> List[Dict]:
+        """Выгрузить все страницы списочного метода (*.list)
+        
+        Первая страница запрашивается обычным вызовом, чтобы узнать total,
+        остальные — через batch по BATCH_LIMIT страниц за вызов.
+        """
+        params = params or {}
+        first = await self._request(method, {**params, "start": 0})
+        items = list(first.get("result") or [])
+        total = int(first.get("total") or len(items))
+        
+        starts = list(range(self.LIST_PAGE_SIZE, total, self.LIST_PAGE_SIZE))
+        if not starts:
+            return items
+        
+        batch = await self.call_batch(
+            {f"s{start}": (method, {**params, "start": start}) for start in starts},
+            max_concurrency=max_concurrency
+        )
+        if batch["errors"]:
+            raise Exception(f"Bitrix24 API error listing {method}: {next(iter(batch['errors'].values()))}")
+        for start in starts:
+            items.extend(batch["result"].get(f"s{start}") or [])
+        return items
+    
+    async def get_deal_details(self, deal_id: str) -> DealDetails:
+        """Получить сделку, её товары и контакт одним вызовом batch"""
+        logger.info(f"Getting deal {deal_id} with products and contact from Bitrix24")
+        batch = await self.call_batch({
+            "deal": ("crm.deal.get", {"id": deal_id}),
+            "products": ("crm.deal.productrows.get", {"id": deal_id}),
+            "contact": ("crm.contact.get", {"id": "$result[deal][CONTACT_ID]"})
+        })
+        
+        if "deal" not in batch["result"]:
+            error = batch["errors"].get("deal", "No result returned")
+            raise Exception(f"Bitrix24 API error: {error}")
+        
+        # Без товаров сделку обрабатывать нельзя: ошибка уходит в повтор задачи
+        if "products" in batch["errors"] or "products" not in batch["result"]:
+            error = batch["errors"].get("products", "No result returned")
+            raise Exception(f"Bitrix24 API error getting products for deal {deal_id}: {error}")
+        
+        deal = batch["result"]["deal"]
+        products = batch["result"]["products"]
+        # Ошибка contact ожидаема, если к сделке не привязан контакт
+        contact = batch["result"].get("contact") if deal.get("CONTACT_ID") else None
+        if deal.get("CONTACT_ID") and "contact" in batch["errors"]:
+            logger.warning(f"Failed to get contact for deal {deal_id}: {batch['errors']['contact']}")
+        
+        return DealDetails(
+            deal=deal,
+            products=products if isinstance(products, list) else [],
+            contact=contact if isinstance(contact, dict) else {}
+        )
     
     async def update_deal_field(self, deal_id: str, field_name: str, value: Any) -> bool:
         """Обновить поле сделки"""
@@ -58,20 +238,27 @@ class Bitrix24Client:
             logger.error(f"Failed to update deal field: {e}")
             return False
     
-    async def update_product_quantity(self, product_id: str, quantity: int) -> bool:
-        """Обновить остаток товара в каталоге"""
-        logger.info(f"Updating product {product_id} quantity to {quantity}")
-        try:
-            await self._call_method("catalog.product.update", {
+    async def update_product_quantities(self, quantities: Dict[str, int]) -> Dict:
+        """Обновить остатки нескольких товаров через batch
+        
+        Возвращает {"updated": [ID товаров], "errors": {ID товара: описание ошибки}}.
+        """
+        logger.info(f"Updating quantity for {len(quantities)} products via batch")
+        commands = {
+            f"p{product_id}": ("catalog.product.update", {
                 "id": product_id,
-                "fields": {
-                    "quantity": quantity
-                }
+                "fields": {"quantity": quantity}
             })
-            return True
-        except Exception as e:
-            logger.error(f"Failed to update product quantity: {e}")
-            return False
+            for product_id, quantity in quantities.items()
+        }
+        batch = await self.call_batch(commands)
+        
+        updated = [key[1:] for key in batch["result"]]
+        errors = {key[1:]: error for key, error in batch["errors"].items()}
+        for product_id, error in errors.items():
+            logger.error(f"Failed to update product {product_id} quantity: {error}")
+        
+        return {"updated": updated, "errors": errors}
     
     async def create_activity(self, deal_id: str, subject: str, description: str) -> bool:
         """Создать активность (комментарий) к сделке"""
@@ -94,5 +281,6 @@ class Bitrix24Client:
             return False
     
     async def close(self):
-        """Закрыть HTTP клиент"""
-        await self.client.aclose()
+        """Закрыть HTTP клиент (общий пул закрывается в lifespan)"""
+        if self._owns_client:
+            await self.client.aclose()
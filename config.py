@@ -8,6 +8,10 @@ class Settings(BaseSettings):
     # Битрикс24
     bitrix24_webhook_url: str
     bitrix24_domain: str
+    bitrix24_max_concurrency: int = 2
+    # Лимит REST API Bitrix24: 2 запроса в секунду, запас 50 (Enterprise: 5 и 250)
+    bitrix24_rate_limit: float = 2.0
+    bitrix24_rate_burst: int = 50
     
     # 1С
     onec_base_url: str
@@ -21,6 +25,8 @@ class Settings(BaseSettings):
     # OpenRouter
     openrouter_api_key: str
     openrouter_model: str = "openai/gpt-oss-120b"
+    ai_report_cache_ttl: int = 3600
+    ai_report_cache_max_size: int = 1000
     
     # Telegram
     telegram_bot_token: str = ""
@@ -29,11 +35,79 @@ class Settings(BaseSettings):
     # Сервер
     server_host: str = "0.0.0.0"
     server_port: int = 8008
+    # Число процессов приложения (воркеры uvicorn во всех контейнерах):
+    # лимит запросов Bitrix24 делится между ними
+    app_processes: int = 1
     log_level: str = "INFO"
+    log_json: bool = False
+    log_enqueue: bool = True
+    log_sample_every: int = 100
+    sql_echo: bool = False
     
     # Синхронизация
     sync_schedule_hour: int = 0
     sync_schedule_minute: int = 0
+    stock_sync_delta: bool = True
+    stock_report_cache_ttl: int = 60
+    # Инкрементальная синхронизация по движениям регистра остатков, с (0 — выключена);
+    # при включённой ночная синхронизация отправляет все позиции (сверка)
+    stock_incremental_interval: int = 60
+    # Движения перечитываются с запасом: документы могут проводиться задним числом, с
+    stock_incremental_overlap: int = 300
+    # Как часто ведомые пробуют стать ведущим и ведущий проверяет блокировку, с
+    leader_check_interval: float = 10.0
+    
+    # Журнал синхронизаций
+    sync_log_batch_size: int = 500
+    sync_log_flush_interval: float = 2.0
+    sync_log_spill_path: str = "logs/sync_log_spill.jsonl"
+    sync_log_retention_days: int = 365
+    # Сжатие больших JSONB-полей: lz4, pglz или пусто (по умолчанию PostgreSQL)
+    sync_log_compression: str = "lz4"
+    
+    # Секционирование и хранение истории
+    stock_snapshot_retention_days: int = 90
+    partition_premake_days: int = 7
+    
+    # Очередь обработки сделок
+    deal_workers: int = 4
+    deal_job_max_attempts: int = 5
+    deal_job_retry_base_seconds: int = 10
+    deal_job_retry_max_seconds: int = 900
+    deal_job_poll_interval: float = 1.0
+    deal_job_lock_timeout: int = 600
+    deal_job_shutdown_timeout: float = 30.0
+    deal_debounce_seconds: int = 5
+    deal_debounce_max_seconds: int = 60
+    
+    # Маппинг товаров
+    mapping_import_chunk_size: int = 1000
+    
+    # HTTP пулы соединений
+    http_max_connections: int = 100
+    http_max_keepalive_connections: int = 20
+    http_keepalive_expiry: float = 30.0
+    http2_enabled: bool = True
+    onec_max_connections: int = 10
+    
+    # Повторы и автомат отключения внешних сервисов
+    upstream_max_retries: int = 3
+    upstream_backoff_base: float = 0.5
+    upstream_backoff_max: float = 30.0
+    circuit_failure_threshold: int = 5
+    circuit_reset_timeout: float = 30.0
+    # Сколько запрос ждёт свободного слота адаптивного лимита, прежде чем отказать
+    upstream_queue_timeout: float = 30.0
+    
+    # 1С OData
+    onec_page_size: int = 1000
+    onec_max_concurrency: int = 4
+    onec_latency_target: float = 5.0
+    
+    # Кэш номенклатуры 1С
+    nomenclature_cache_ttl: int = 3600
+    nomenclature_cache_max_size: int = 50000
+    nomenclature_refresh_interval: int = 900
     
     class Config:
         env_file = ".env"
@@ -0,0 +1,98 @@
+"""Индекс контрагентов 1С по телефону в PostgreSQL"""
+import re
+from datetime import datetime
+from typing import Dict, Optional
+from loguru import logger
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from database import async_session_maker, CounterpartyPhone, SyncState
+
+
+# Ключ SyncState: время завершения полной выгрузки контрагентов из 1С
+BACKFILL_COMPLETED_KEY = "counterparty_backfill_completed"
+
+# После успешной выгрузки флаг не сбрасывается, поэтому кэшируется в процессе
+_backfilled = False
+
+
+def normalize_phone(phone: str) -> Optional[str]:
+    """Последние 10 цифр номера или None, если номер слишком короткий"""
+    digits = re.sub(r'\D', '', phone or '')
+    if len(digits) < 5:
+        return None
+    return digits[-10:]
+
+
+async def find_counterparty(phone: str) -> Optional[str]:
+    """Ref_Key контрагента по номеру телефона"""
+    normalized = normalize_phone(phone)
+    if not normalized:
+        return None
+    
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(CounterpartyPhone.onec_ref_key).where(CounterpartyPhone.phone == normalized)
+        )
+        return result.scalar_one_or_none()
+
+
+async def remember_counterparty(phone: str, ref_key: str):
+    """Сохранить соответствие телефон -> контрагент"""
+    normalized = normalize_phone(phone)
+    if not normalized:
+        return
+    
+    async with async_session_maker() as session:
+        stmt = insert(CounterpartyPhone).values(phone=normalized, onec_ref_key=ref_key)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[CounterpartyPhone.phone],
+            set_={"onec_ref_key": stmt.excluded.onec_ref_key}
+        )
+        await session.execute(stmt)
+        await session.commit()
+
+
+async def remember_counterparties(phones: Dict[str, str]) -> int:
+    """Массово сохранить соответствия {телефон: Ref_Key}, не перезаписывая существующие"""
+    rows = {}
+    for phone, ref_key in phones.items():
+        normalized = normalize_phone(phone)
+        if normalized:
+            rows[normalized] = ref_key
+    if not rows:
+        return 0
+    
+    async with async_session_maker() as session:
+        stmt = insert(CounterpartyPhone).values([
+            {"phone": phone, "onec_ref_key": ref_key} for phone, ref_key in rows.items()
+        ]).on_conflict_do_nothing(index_elements=[CounterpartyPhone.phone])
+        await session.execute(stmt)
+        await session.commit()
+    
+    logger.info(f"Stored {len(rows)} counterparty phones")
+    return len(rows)
+
+
+async def is_backfilled() -> bool:
+    """Завершалась ли полная выгрузка контрагентов из 1С"""
+    global _backfilled
+    if not _backfilled:
+        async with async_session_maker() as session:
+            result = await session.execute(select(SyncState.value).where(SyncState.key == BACKFILL_COMPLETED_KEY))
+            _backfilled = result.scalar_one_or_none() is not None
+    return _backfilled
+
+
+async def mark_backfilled():
+    """Отметить завершение полной выгрузки контрагентов"""
+    global _backfilled
+    now = datetime.utcnow()
+    stmt = insert(SyncState).values(key=BACKFILL_COMPLETED_KEY, value=now.isoformat(), updated_at=now)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[SyncState.key],
+        set_={"value": stmt.excluded.value, "updated_at": now}
+    )
+    async with async_session_maker() as session:
+        await session.execute(stmt)
+        await session.commit()
+    _backfilled = True
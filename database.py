@@ -1,8 +1,13 @@
 """Модуль работы с базой данных"""
+import re
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import String, DateTime, Text, Integer
-from datetime import datetime
+from sqlalchemy import String, DateTime, Text, Integer, Index, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import AsyncConnection
+from datetime import datetime, date, timedelta
+from typing import List, Optional, Tuple
+from loguru import logger
 from config import settings
 
 
@@ -14,8 +19,17 @@ if db_url.startswith("postgresql://"):
 # Конвертация sslmode в ssl для asyncpg
 db_url = db_url.replace("sslmode=require", "ssl=require")
 
+# DSN для прямых соединений asyncpg (advisory lock, LISTEN): без указания драйвера и с sslmode
+asyncpg_dsn = re.sub(r"^postgresql\+asyncpg://", "postgresql://", settings.database_url)
+asyncpg_dsn = re.sub(r"([?&])ssl=", r"\1sslmode=", asyncpg_dsn)
+
+# Пространство ключей advisory lock приложения (остальные ключи — в leader_election)
+LOCK_NAMESPACE = 0x1C24B
+# Создание и миграция схемы: выполняется одним процессом за раз
+LOCK_INIT_DB = 5
+
 # Создание движка БД
-engine = create_async_engine(db_url, echo=True)
+engine = create_async_engine(db_url, echo=settings.sql_echo)
 async_session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 
@@ -38,36 +52,292 @@ class ProductMapping(Base):
 
 
 class SyncLog(Base):
-    """Лог синхронизаций"""
+    """Лог синхронизаций (секционирован по месяцам created_at)"""
     __tablename__ = "bitrix_1c_sync_log"
+    __table_args__ = (
+        Index("ix_bitrix_1c_sync_log_created_id", "created_at", "id"),
+        Index("ix_bitrix_1c_sync_log_type_created", "sync_type", "created_at"),
+        Index("ix_bitrix_1c_sync_log_status_created", "status", "created_at"),
+        Index("ix_bitrix_1c_sync_log_entity_created", "entity_id", "created_at"),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
     
-    id: Mapped[int] = mapped_column(primary_key=True)
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     sync_type: Mapped[str] = mapped_column(String(50))
     direction: Mapped[str] = mapped_column(String(50))
     status: Mapped[str] = mapped_column(String(20))
     entity_id: Mapped[str] = mapped_column(String(100), nullable=True)
-    request_data: Mapped[str] = mapped_column(Text, nullable=True)
-    response_data: Mapped[str] = mapped_column(Text, nullable=True)
+    request_data: Mapped[dict] = mapped_column(JSONB, nullable=True)
+    response_data: Mapped[dict] = mapped_column(JSONB, nullable=True)
     error_message: Mapped[str] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, primary_key=True)
+
+
+class DealJob(Base):
+    """Очередь задач обработки сделок"""
+    __tablename__ = "bitrix_1c_deal_job"
+    __table_args__ = (
+        Index("ix_bitrix_1c_deal_job_status_run_at", "status", "run_at"),
+        # Не больше одной ожидающей задачи на сделку: повторные события её откладывают
+        Index("uq_bitrix_1c_deal_job_pending_deal", "deal_id", unique=True, postgresql_where=text("status = 'pending'")),
+    )
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    deal_id: Mapped[str] = mapped_column(String(100), index=True)
+    event: Mapped[str] = mapped_column(String(50), nullable=True)
+    status: Mapped[str] = mapped_column(String(20), default="pending")
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    run_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    locked_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    last_error: Mapped[str] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class ProcessedDeal(Base):
+    """Сделки, по которым уже создан документ в 1С (по хэшу товаров и суммы)"""
+    __tablename__ = "bitrix_1c_processed_deal"
+    
+    deal_id: Mapped[str] = mapped_column(String(100), primary_key=True)
+    content_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    # Пусто — ответ на создание документа не получен, перед повтором документ ищется в 1С
+    order_number: Mapped[str] = mapped_column(String(100), nullable=True)
+    # Номер документа записан в сделку Bitrix24 (пусто — запись нужно повторить)
+    bitrix24_synced_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
 
 class StockSnapshot(Base):
-    """Снимок остатков товаров"""
+    """Снимок остатков товаров (секционирован по дням snapshot_date)"""
     __tablename__ = "bitrix_1c_stock_snapshot"
+    __table_args__ = (
+        Index("ix_bitrix_1c_stock_snapshot_code_date", "product_code", "snapshot_date"),
+        {"postgresql_partition_by": "RANGE (snapshot_date)"},
+    )
     
-    id: Mapped[int] = mapped_column(primary_key=True)
-    product_code: Mapped[str] = mapped_column(String(100), index=True)
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    product_code: Mapped[str] = mapped_column(String(100))
     product_name: Mapped[str] = mapped_column(String(500))
     quantity: Mapped[int] = mapped_column(Integer)
     warehouse: Mapped[str] = mapped_column(String(200))
-    snapshot_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+    snapshot_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, primary_key=True)
+
+
+class StockLastPushed(Base):
+    """Последний отправленный в Bitrix24 остаток по коду 1С (одна строка на товар)
+
+    С ним сравнивается delta-прогон, чтобы не читать все секции снимков.
+    """
+    __tablename__ = "bitrix_1c_stock_last_pushed"
+    
+    product_code: Mapped[str] = mapped_column(String(100), primary_key=True)
+    quantity: Mapped[int] = mapped_column(Integer)
+    pushed_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class CounterpartyPhone(Base):
+    """Индекс контрагентов 1С по нормализованному номеру телефона"""
+    __tablename__ = "bitrix_1c_counterparty_phone"
+    
+    phone: Mapped[str] = mapped_column(String(20), primary_key=True)
+    onec_ref_key: Mapped[str] = mapped_column(String(36))
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class SyncState(Base):
+    """Состояние фоновых синхронизаций между запусками (водяные знаки и т.п.)"""
+    __tablename__ = "bitrix_1c_sync_state"
+    
+    key: Mapped[str] = mapped_column(String(100), primary_key=True)
+    value: Mapped[str] = mapped_column(Text)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class AIReportCache(Base):
+    """Кэш ИИ-отчётов по нормализованному запросу, модели и периоду данных"""
+    __tablename__ = "bitrix_1c_ai_report_cache"
+    
+    cache_key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    query: Mapped[str] = mapped_column(Text)
+    model: Mapped[str] = mapped_column(String(200))
+    date_from: Mapped[datetime] = mapped_column(DateTime)
+    date_to: Mapped[datetime] = mapped_column(DateTime)
+    report: Mapped[str] = mapped_column(Text)
+    hits: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, index=True)
+    last_used_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+
+# Таблицы, секционированные по диапазону дат: имя -> (колонка, шаг секции "day"/"month")
+PARTITIONED_TABLES = {
+    StockSnapshot.__tablename__: ("snapshot_date", "day"),
+    SyncLog.__tablename__: ("created_at", "month"),
+}
+
+# Сжатие TOAST для больших JSONB-полей (PostgreSQL 14+): таблица -> колонки
+COMPRESSED_COLUMNS = {
+    SyncLog.__tablename__: ("request_data", "response_data"),
+}
+
+
+def _partition_range(day: date, step: str) -> Tuple[date, date]:
+    """Границы секции, в которую попадает день"""
+    if step == "month":
+        start = day.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1)
+        return start, end
+    return day, day + timedelta(days=1)
+
+
+def _partition_name(table: str, start: date, step: str) -> str:
+    return f"{table}_p{start.strftime('%Y%m' if step == 'month' else '%Y%m%d')}"
+
+
+async def ensure_partitions(conn: AsyncConnection, table: str, since: date, until: date):
+    """Создать недостающие секции таблицы на интервал дат [since, until]"""
+    _, step = PARTITIONED_TABLES[table]
+    await conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+    
+    day = since
+    while day <= until:
+        start, end = _partition_range(day, step)
+        await conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {_partition_name(table, start, step)} "
+            f"PARTITION OF {table} FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        ))
+        day = end
+
+
+async def drop_partitions_before(conn: AsyncConnection, table: str, cutoff: date) -> List[str]:
+    """Удалить секции, целиком лежащие раньше cutoff (вместо DELETE по таблице)"""
+    _, step = PARTITIONED_TABLES[table]
+    result = await conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :table"
+    ), {"table": table})
+    
+    dropped = []
+    prefix = f"{table}_p"
+    for (name,) in result.all():
+        if not name.startswith(prefix):
+            continue
+        try:
+            start = datetime.strptime(name[len(prefix):], '%Y%m' if step == 'month' else '%Y%m%d').date()
+        except ValueError:
+            continue
+        if _partition_range(start, step)[1] <= cutoff:
+            await conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+            dropped.append(name)
+    return dropped
+
+
+async def _detach_unpartitioned(conn: AsyncConnection, table: str) -> Optional[str]:
+    """Переименовать старую несекционированную таблицу, чтобы создать секционированную"""
+    result = await conn.execute(text(
+        "SELECT relkind FROM pg_class WHERE relname = :table AND relnamespace = 'public'::regnamespace"
+    ), {"table": table})
+    relkind = result.scalar_one_or_none()
+    if relkind != 'r':
+        return None
+    
+    legacy = f"{table}_legacy"
+    logger.warning(f"Migrating {table} to a partitioned table")
+    await conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+    indexes = await conn.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = :table"), {"table": legacy})
+    for (index_name,) in indexes.all():
+        await conn.execute(text(f"ALTER INDEX {index_name} RENAME TO {(index_name + '_legacy')[:63]}"))
+    return legacy
+
+
+async def _copy_legacy(conn: AsyncConnection, table: str, legacy: str, since: date):
+    """Перенести данные из старой таблицы в секционированную и удалить её"""
+    column, _ = PARTITIONED_TABLES[table]
+    table_columns = Base.metadata.tables[table].columns
+    columns = ", ".join(c.name for c in table_columns)
+    # Старые текстовые поля с json.dumps переносятся в JSONB приведением типа
+    values = ", ".join(f"{c.name}::jsonb" if isinstance(c.type, JSONB) else c.name for c in table_columns)
+    await conn.execute(text(
+        f"INSERT INTO {table} ({columns}) SELECT {values} FROM {legacy} WHERE {column} >= :since"
+    ), {"since": since})
+    await conn.execute(text(
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE((SELECT MAX(id) FROM {table}), 1))"
+    ))
+    await conn.execute(text(f"DROP TABLE {legacy}"))
+
+
+def partition_retention_days(table: str) -> int:
+    """Срок хранения секций таблицы в днях"""
+    return {
+        StockSnapshot.__tablename__: settings.stock_snapshot_retention_days,
+        SyncLog.__tablename__: settings.sync_log_retention_days,
+    }[table]
+
+
+async def maintain_partitions():
+    """Создать секции на ближайшие дни и удалить устаревшие"""
+    today = datetime.utcnow().date()
+    async with engine.begin() as conn:
+        for table in PARTITIONED_TABLES:
+            await ensure_partitions(conn, table, today, today + timedelta(days=settings.partition_premake_days))
+            dropped = await drop_partitions_before(conn, table, today - timedelta(days=partition_retention_days(table)))
+            if dropped:
+                logger.info(f"Dropped expired partitions: {', '.join(dropped)}")
+
+
+async def _set_compression(conn: AsyncConnection):
+    """Включить выбранный метод сжатия для больших JSONB-полей"""
+    method = settings.sync_log_compression
+    if not method:
+        return
+    for table, columns in COMPRESSED_COLUMNS.items():
+        for column in columns:
+            try:
+                async with conn.begin_nested():
+                    await conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} SET COMPRESSION {method}"))
+            except Exception as e:
+                logger.warning(f"Compression {method} is not available for {table}.{column}: {e}")
+
+
+def _create_missing_indexes(sync_conn):
+    """create_all не добавляет новые индексы в уже существующие таблицы"""
+    for table in Base.metadata.sorted_tables:
+        if table.name in PARTITIONED_TABLES:
+            continue
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
 
 
 async def init_db():
-    """Инициализация базы данных"""
+    """Инициализация базы данных
+    
+    Выполняется под транзакционной advisory-блокировкой: воркеры, запущенные
+    одновременно, не переименовывают и не переносят таблицы параллельно.
+    """
+    today = datetime.utcnow().date()
     async with engine.begin() as conn:
+        await conn.execute(
+            text("SELECT pg_advisory_xact_lock(:namespace, :key)"),
+            {"namespace": LOCK_NAMESPACE, "key": LOCK_INIT_DB}
+        )
+        legacy = {table: await _detach_unpartitioned(conn, table) for table in PARTITIONED_TABLES}
         await conn.run_sync(Base.metadata.create_all)
+        # Колонка добавлена позже: для уже обработанных сделок запись в Bitrix24 считается выполненной
+        await conn.execute(text(
+            f"ALTER TABLE {ProcessedDeal.__tablename__} ADD COLUMN IF NOT EXISTS bitrix24_synced_at TIMESTAMP DEFAULT now()"
+        ))
+        await conn.execute(text(f"ALTER TABLE {ProcessedDeal.__tablename__} ALTER COLUMN bitrix24_synced_at DROP DEFAULT"))
+        await conn.run_sync(_create_missing_indexes)
+        
+        for table, legacy_table in legacy.items():
+            since = today - timedelta(days=partition_retention_days(table))
+            await ensure_partitions(conn, table, since, today + timedelta(days=settings.partition_premake_days))
+            if legacy_table:
+                await _copy_legacy(conn, table, legacy_table, since)
+        
+        await _set_compression(conn)
 
 
 async def get_session() -> AsyncSession:
@@ -0,0 +1,120 @@
+"""Общие пулы HTTP-соединений к внешним сервисам"""
+import httpx
+from importlib.util import find_spec
+from typing import Dict, Optional
+from loguru import logger
+from config import settings
+from metrics import InstrumentedTransport
+from upstream_scheduler import AIMDLimiter, ScheduledTransport, TokenBucket
+
+
+class HTTPClientRegistry:
+    """Реестр HTTP клиентов: один keep-alive пул на каждый внешний сервис.
+
+    Создаётся один раз в lifespan приложения. Клиенты Bitrix24, 1С, Telegram
+    и OpenRouter берут пул отсюда, а не открывают собственный.
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._overrides: Dict[str, httpx.AsyncBaseTransport] = {}
+
+    def _limits(self, max_connections: int) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=min(settings.http_max_keepalive_connections, max_connections),
+            keepalive_expiry=settings.http_keepalive_expiry
+        )
+
+    def _http2_available(self) -> bool:
+        if not settings.http2_enabled:
+            return False
+        if find_spec("h2") is None:
+            logger.warning("HTTP/2 disabled: package 'h2' is not installed")
+            return False
+        return True
+
+    def _transport(
+        self,
+        name: str,
+        max_connections: int,
+        http2: bool = False,
+        bucket: TokenBucket = None,
+        limiter: AIMDLimiter = None
+    ) -> ScheduledTransport:
+        """Пул соединений с планировщиком запросов и метриками каждой попытки"""
+        transport = self._overrides.get(name) or httpx.AsyncHTTPTransport(
+            limits=self._limits(max_connections),
+            http2=http2
+        )
+        return ScheduledTransport(name, InstrumentedTransport(name, transport), bucket=bucket, limiter=limiter)
+    
+    def _build_clients(self) -> Dict[str, httpx.AsyncClient]:
+        http2 = self._http2_available()
+        return {
+            "bitrix24": httpx.AsyncClient(
+                timeout=30.0,
+                transport=self._transport(
+                    "bitrix24",
+                    settings.http_max_connections,
+                    http2,
+                    # Лимит Bitrix24 общий на портал: делится между всеми процессами приложения
+                    bucket=TokenBucket(
+                        settings.bitrix24_rate_limit / settings.app_processes,
+                        max(1, settings.bitrix24_rate_burst // settings.app_processes)
+                    )
+                )
+            ),
+            # Публикация 1С на IIS работает по HTTP/1.1, пул ограничен poolSize из default.vrd
+            "onec": httpx.AsyncClient(
+                timeout=60.0,
+                auth=(settings.onec_username, settings.onec_password),
+                transport=self._transport(
+                    "onec",
+                    settings.onec_max_connections,
+                    limiter=AIMDLimiter(
+                        "onec",
+                        initial=settings.onec_max_concurrency,
+                        minimum=1,
+                        maximum=settings.onec_max_connections,
+                        latency_target=settings.onec_latency_target
+                    )
+                )
+            ),
+            "telegram": httpx.AsyncClient(
+                timeout=30.0,
+                transport=self._transport("telegram", settings.http_max_connections, http2)
+            ),
+            "openrouter": httpx.AsyncClient(
+                timeout=60.0,
+                transport=self._transport("openrouter", settings.http_max_connections, http2)
+            ),
+        }
+
+    async def start(self, transports: Dict[str, httpx.AsyncBaseTransport] = None):
+        """Создать пулы соединений
+
+        transports подменяет транспорт отдельных сервисов (локальные заглушки в бенчмарке).
+        """
+        if self._clients:
+            return
+        self._overrides = transports or {}
+        self._clients = self._build_clients()
+        logger.info(f"HTTP client pools started: {', '.join(self._clients)}")
+
+    def get(self, name: str) -> Optional[httpx.AsyncClient]:
+        """Общий клиент для сервиса или None, если реестр не запущен"""
+        return self._clients.get(name)
+
+    async def close(self):
+        """Закрыть все пулы соединений"""
+        clients, self._clients = self._clients, {}
+        for name, client in clients.items():
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.error(f"Error closing HTTP client {name}: {e}")
+        logger.info("HTTP client pools closed")
+
+
+http_clients = HTTPClientRegistry()
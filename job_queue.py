@@ -0,0 +1,232 @@
+"""Очередь обработки сделок в PostgreSQL"""
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional
+from loguru import logger
+from sqlalchemy import select, update, and_, or_, exists, func, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import settings
+from database import async_session_maker, DealJob
+from telegram_bot import TelegramBot
+
+
+async def enqueue_deal_job(session: AsyncSession, deal_id: str, event: str = None) -> int:
+    """Поставить сделку в очередь на обработку
+    
+    Задача запускается через deal_debounce_seconds. Если по сделке уже есть
+    ожидающая задача, новое событие не создаёт вторую, а сдвигает её запуск
+    (но не дальше deal_debounce_max_seconds от первого события).
+    """
+    now = datetime.utcnow()
+    stmt = insert(DealJob).values(
+        deal_id=deal_id,
+        event=event,
+        status="pending",
+        attempts=0,
+        run_at=now + timedelta(seconds=settings.deal_debounce_seconds),
+        created_at=now,
+        updated_at=now
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DealJob.deal_id],
+        index_where=text("status = 'pending'"),
+        set_={
+            "event": stmt.excluded.event,
+            "run_at": func.least(
+                func.greatest(DealJob.run_at, stmt.excluded.run_at),
+                DealJob.created_at + timedelta(seconds=settings.deal_debounce_max_seconds)
+            ),
+            "updated_at": now
+        }
+    ).returning(DealJob.id)
+    result = await session.execute(stmt)
+    job_id = result.scalar_one()
+    await session.commit()
+    return job_id
+
+
+def retry_delay(attempts: int) -> int:
+    """Задержка перед повтором: экспоненциальная с ограничением сверху"""
+    delay = settings.deal_job_retry_base_seconds * (2 ** max(attempts - 1, 0))
+    return min(delay, settings.deal_job_retry_max_seconds)
+
+
+@dataclass
+class ClaimedJob:
+    """Взятая в работу задача (отвязана от сессии: rollback не сбрасывает поля)"""
+    id: int
+    deal_id: str
+    attempts: int
+
+
+class DealJobWorkerPool:
+    """Пул воркеров, забирающих задачи через SELECT ... FOR UPDATE SKIP LOCKED
+
+    Каждый воркер работает в своей сессии БД. Неудачные задачи повторяются
+    с экспоненциальной задержкой, после deal_job_max_attempts попыток
+    переводятся в статус dead. Пока задача выполняется, воркер продлевает
+    locked_at, чтобы другой воркер не забрал её по deal_job_lock_timeout.
+    """
+
+    def __init__(self):
+        self.handler: Optional[Callable[[str, AsyncSession], Awaitable]] = None
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = asyncio.Event()
+
+    async def _claim(self, session: AsyncSession) -> Optional[ClaimedJob]:
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=settings.deal_job_lock_timeout)
+        running = aliased(DealJob)
+        job_id = (
+            select(DealJob.id)
+            .where(or_(
+                and_(DealJob.status == "pending", DealJob.run_at <= now),
+                # Задача зависшего или упавшего воркера
+                and_(DealJob.status == "processing", DealJob.locked_at < stale)
+            ))
+            # Одна сделка не обрабатывается двумя воркерами одновременно
+            .where(~exists().where(and_(
+                running.deal_id == DealJob.deal_id,
+                running.id != DealJob.id,
+                running.status == "processing",
+                running.locked_at >= stale
+            )))
+            .order_by(DealJob.run_at)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        stmt = (
+            update(DealJob)
+            .where(DealJob.id == job_id)
+            .values(status="processing", locked_at=now, attempts=DealJob.attempts + 1, updated_at=now)
+            .returning(DealJob.id, DealJob.deal_id, DealJob.attempts)
+        )
+        result = await session.execute(stmt)
+        row = result.one_or_none()
+        await session.commit()
+        return ClaimedJob(*row) if row else None
+
+    async def _has_pending(self, session: AsyncSession, deal_id: str) -> bool:
+        result = await session.execute(
+            select(exists().where(and_(DealJob.deal_id == deal_id, DealJob.status == "pending")))
+        )
+        return result.scalar()
+
+    async def _finish(self, session: AsyncSession, job: ClaimedJob, error: Exception = None):
+        now = datetime.utcnow()
+        if error is None:
+            values = {"status": "done", "last_error": None}
+        elif await self._has_pending(session, job.deal_id):
+            # Более новое событие по сделке уже в очереди и обработает её заново
+            values = {"status": "superseded", "last_error": str(error)}
+        elif job.attempts >= settings.deal_job_max_attempts:
+            values = {"status": "dead", "last_error": str(error)}
+        else:
+            values = {
+                "status": "pending",
+                "last_error": str(error),
+                "run_at": now + timedelta(seconds=retry_delay(job.attempts))
+            }
+        try:
+            await session.execute(
+                update(DealJob).where(DealJob.id == job.id).values(locked_at=None, updated_at=now, **values)
+            )
+            await session.commit()
+        except IntegrityError:
+            # После проверки _has_pending по сделке пришло новое событие:
+            # вторая ожидающая задача нарушила бы уникальный индекс
+            await session.rollback()
+            values = {"status": "superseded", "last_error": str(error)}
+            await session.execute(
+                update(DealJob).where(DealJob.id == job.id).values(locked_at=None, updated_at=now, **values)
+            )
+            await session.commit()
+
+        if values["status"] == "dead":
+            logger.error(f"Deal job {job.id} for deal {job.deal_id} moved to dead-letter after {job.attempts} attempts: {error}")
+            if settings.telegram_bot_token and settings.telegram_chat_id:
+                telegram = TelegramBot(settings.telegram_bot_token, settings.telegram_chat_id)
+                await telegram.notify_error(f"Ошибка обработки сделки {job.deal_id}: {error}")
+                await telegram.close()
+        elif error is not None:
+            logger.warning(f"Deal job {job.id} for deal {job.deal_id} failed (attempt {job.attempts}), retry scheduled: {error}")
+
+    async def _heartbeat(self, job: ClaimedJob):
+        """Продлевать блокировку задачи, пока она выполняется (в отдельной сессии)"""
+        interval = settings.deal_job_lock_timeout / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with async_session_maker() as session:
+                    await session.execute(
+                        update(DealJob)
+                        .where(DealJob.id == job.id, DealJob.status == "processing")
+                        .values(locked_at=datetime.utcnow())
+                    )
+                    await session.commit()
+            except Exception as e:
+                logger.warning(f"Failed to extend lock of deal job {job.id}: {e}")
+
+    async def _idle(self):
+        """Пауза между опросами очереди, прерываемая остановкой пула"""
+        try:
+            await asyncio.wait_for(self._stopping.wait(), settings.deal_job_poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _worker(self, number: int):
+        while not self._stopping.is_set():
+            try:
+                async with async_session_maker() as session:
+                    job = await self._claim(session)
+                    if job is None:
+                        await self._idle()
+                        continue
+
+                    logger.info(f"Worker {number} processing deal job {job.id} (deal {job.deal_id})")
+                    heartbeat = asyncio.create_task(self._heartbeat(job))
+                    try:
+                        await self.handler(job.deal_id, session)
+                    except Exception as e:
+                        await session.rollback()
+                        await self._finish(session, job, e)
+                    else:
+                        await self._finish(session, job)
+                    finally:
+                        heartbeat.cancel()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Deal job worker {number} error: {e}")
+                await self._idle()
+
+    def start(self, handler: Callable[[str, AsyncSession], Awaitable], workers: int):
+        """Запустить воркеров"""
+        self.handler = handler
+        self._stopping.clear()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(workers)]
+        logger.info(f"Started {workers} deal job workers")
+
+    async def stop(self):
+        """Остановить воркеров
+
+        Новые задачи не берутся, текущим даётся deal_job_shutdown_timeout на
+        завершение. Прерванные задачи будут подхвачены после lock timeout.
+        """
+        self._stopping.set()
+        if self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=settings.deal_job_shutdown_timeout)
+            if pending:
+                logger.warning(f"Cancelling {len(pending)} deal job workers still running after {settings.deal_job_shutdown_timeout}s")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+deal_job_workers = DealJobWorkerPool()
@@ -0,0 +1,116 @@
+"""Выбор ведущего экземпляра через advisory lock PostgreSQL
+
+Плановые задачи выполняет только процесс, удерживающий блокировку LOCK_LEADER.
+Блокировка сессионная и живёт на отдельном соединении: при падении процесса
+PostgreSQL освобождает её, и другой экземпляр становится ведущим.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Optional
+import asyncpg
+from loguru import logger
+from sqlalchemy import text
+from config import settings
+from database import async_session_maker, asyncpg_dsn, LOCK_NAMESPACE
+from metrics import SCHEDULER_LEADER
+
+
+# Ключи advisory lock в пространстве LOCK_NAMESPACE (LOCK_INIT_DB = 5 — инициализация схемы)
+LOCK_LEADER = 1
+LOCK_STOCK_SYNC = 2
+# Отправка остатков в Bitrix24: полная синхронизация ждёт её, инкрементальная пропускает ход
+LOCK_STOCK_PUSH = 3
+LOCK_COUNTERPARTY_BACKFILL = 4
+
+
+@asynccontextmanager
+async def advisory_lock(key: int, wait: bool = False) -> AsyncIterator[bool]:
+    """Взять блокировку на время блока, отдаёт True при успехе
+
+    Без wait блокировка только пробуется; с wait — ожидается до освобождения.
+    """
+    connection = await asyncpg.connect(asyncpg_dsn)
+    try:
+        if wait:
+            await connection.execute("SELECT pg_advisory_lock($1, $2)", LOCK_NAMESPACE, key)
+            yield True
+        else:
+            yield await connection.fetchval("SELECT pg_try_advisory_lock($1, $2)", LOCK_NAMESPACE, key)
+    finally:
+        # Закрытие сессии снимает блокировку
+        await connection.close()
+
+
+async def is_locked(key: int) -> bool:
+    """Удерживает ли блокировку какой-либо процесс"""
+    async with async_session_maker() as session:
+        result = await session.execute(text(
+            "SELECT EXISTS (SELECT 1 FROM pg_locks WHERE locktype = 'advisory' "
+            "AND classid = :namespace AND objid = :key AND objsubid = 2 AND granted)"
+        ), {"namespace": LOCK_NAMESPACE, "key": key})
+        return result.scalar()
+
+
+class LeaderElection:
+    """Фоновая попытка стать ведущим и проверка, что блокировка всё ещё удерживается"""
+    
+    def __init__(self, check_interval: float):
+        self.check_interval = check_interval
+        self.is_leader = False
+        self._on_elected: Optional[Callable[[], None]] = None
+        self._on_demoted: Optional[Callable[[], None]] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    def _set_leader(self, is_leader: bool):
+        if is_leader == self.is_leader:
+            return
+        self.is_leader = is_leader
+        SCHEDULER_LEADER.set(1 if is_leader else 0)
+        if is_leader:
+            logger.info("This instance is now the scheduler leader")
+            self._on_elected()
+        else:
+            logger.warning("This instance is no longer the scheduler leader")
+            self._on_demoted()
+    
+    async def _run(self):
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(asyncpg_dsn)
+                while not await connection.fetchval("SELECT pg_try_advisory_lock($1, $2)", LOCK_NAMESPACE, LOCK_LEADER):
+                    await asyncio.sleep(self.check_interval)
+                self._set_leader(True)
+                # Потеря соединения означает потерю блокировки
+                while True:
+                    await asyncio.sleep(self.check_interval)
+                    await asyncio.wait_for(connection.fetchval("SELECT 1"), timeout=self.check_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Leader election connection error: {e}")
+            finally:
+                self._set_leader(False)
+                if connection and not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(self.check_interval)
+    
+    def start(self, on_elected: Callable[[], None], on_demoted: Callable[[], None]):
+        """Начать борьбу за роль ведущего"""
+        if self._task and not self._task.done():
+            return
+        self._on_elected, self._on_demoted = on_elected, on_demoted
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Сложить полномочия (блокировка освобождается закрытием соединения)"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+leader_election = LeaderElection(settings.leader_check_interval)
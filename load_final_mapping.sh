@@ -18,22 +18,15 @@ declare -a mappings=(
 "315|Конверт для штучек бумажный бордовый RT|RT-ENVELOPE|Футляр для маникюрных принадлежностей"
 )
 
-for mapping in "${mappings[@]}"; do
-    IFS='|' read -r id name code name_1c <<< "$mapping"
-    
-    echo "➕ ID $id → $code"
-    
-    curl -s -X POST https://bizdnai.com/morozov/api/mapping/product \
-      -H "Content-Type: application/json" \
-      -d "{
-        \"bitrix24_product_id\": \"$id\",
-        \"bitrix24_product_name\": \"$name\",
-        \"onec_product_code\": \"$code\",
-        \"onec_product_name\": \"$name_1c\"
-      }" > /dev/null && echo "   ✅" || echo "   ❌"
-    
-    sleep 0.1
-done
+# Все строки одним запросом: ответ содержит created/updated/rejected
+printf '%s\n' "${mappings[@]}" | python3 -c '
+import json, sys
+fields = ("bitrix24_product_id", "bitrix24_product_name", "onec_product_code", "onec_product_name")
+json.dump([dict(zip(fields, line.rstrip("\n").split("|"))) for line in sys.stdin if line.strip()], sys.stdout, ensure_ascii=False)
+' | curl -s -X POST https://bizdnai.com/morozov/api/mapping/products/bulk \
+  -H "Content-Type: application/json" \
+  --data-binary @- \
+  | python3 -c "import json,sys; r=json.load(sys.stdin); print(f\"➕ Создано: {r.get('created')}, обновлено: {r.get('updated')}, отклонено: {r.get('rejected')}\"); [print(f\"   ❌ {e}\") for e in r.get('errors', [])]"
 
 echo ""
 echo "✅ Загружено!"
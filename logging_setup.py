@@ -0,0 +1,51 @@
+"""Настройка логирования"""
+import sys
+from collections import Counter
+from loguru import logger
+from config import settings
+
+
+# Логгер для частых отладочных событий: пишется только каждая N-я запись места вызова
+sampled_logger = logger.bind(sample=True)
+
+_sample_counts: Counter = Counter()
+
+
+def _sample_patcher(record):
+    """Решение о прореживании записи с sample=True — один раз на запись, для всех sink"""
+    if not record["extra"].get("sample"):
+        return
+    key = (record["name"], record["line"])
+    _sample_counts[key] += 1
+    record["extra"]["sampled_out"] = settings.log_sample_every > 1 and _sample_counts[key] % settings.log_sample_every != 1
+
+
+def _sample_filter(record) -> bool:
+    """Пропустить записи, не прошедшие прореживание"""
+    return not record["extra"].get("sampled_out")
+
+
+def setup_logging():
+    """Настроить вывод логов
+
+    Записи ставятся в очередь (enqueue) и пишутся отдельным потоком, чтобы запись
+    в файл не блокировала event loop. При LOG_JSON=true пишется JSON по строке на запись.
+    """
+    logger.remove()
+    logger.configure(patcher=_sample_patcher)
+    logger.add(
+        sys.stderr,
+        level=settings.log_level,
+        enqueue=settings.log_enqueue,
+        serialize=settings.log_json,
+        filter=_sample_filter
+    )
+    logger.add(
+        "logs/app.log",
+        rotation="1 day",
+        retention="30 days",
+        level=settings.log_level,
+        enqueue=settings.log_enqueue,
+        serialize=settings.log_json,
+        filter=_sample_filter
+    )
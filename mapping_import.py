@@ -0,0 +1,138 @@
+"""Массовая загрузка маппинга товаров"""
+import codecs
+import csv
+import json
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from sqlalchemy import literal_column
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import ProductMapping
+
+
+MAPPING_FIELDS = ("bitrix24_product_id", "bitrix24_product_name", "onec_product_code", "onec_product_name")
+
+# Заголовок mapping.csv
+CSV_HEADER = ("bitrix24_id", "bitrix24_name", "onec_code", "onec_name")
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Построчно декодировать поток байтов в UTF-8"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+
+async def iter_json_array(chunks: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    """Поэлементно разобрать JSON-массив из потока байтов
+
+    Элемент отдаётся, как только получен целиком: массив в памяти не
+    собирается. Ошибка синтаксиса — ValueError.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    parser = json.JSONDecoder()
+    buffer = ""
+    # start — ждём "[", first — первый элемент или "]", value — элемент после ",",
+    # after — "," или "]", done — массив закрыт
+    state = "start"
+    iterator = chunks.__aiter__()
+    final = False
+    while not final:
+        try:
+            chunk = await iterator.__anext__()
+        except StopAsyncIteration:
+            chunk, final = b"", True
+        buffer += decoder.decode(chunk, final=final)
+        
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n":
+                position += 1
+            if position == len(buffer):
+                break
+            char = buffer[position]
+            if state == "done":
+                raise ValueError("Extra data after JSON array")
+            if state == "start":
+                if char != "[":
+                    raise ValueError("Expected a JSON array")
+                state, position = "first", position + 1
+            elif state == "after" or (state == "first" and char == "]"):
+                if char not in ",]":
+                    raise ValueError(f"Expected ',' or ']' at position {position}")
+                state, position = ("value" if char == "," else "done"), position + 1
+            else:
+                try:
+                    item, end = parser.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    break
+                # Число в конце буфера может продолжиться в следующем куске
+                if end == len(buffer) and not final:
+                    break
+                yield item
+                state, position = "after", end
+        buffer = buffer[position:]
+    
+    if state != "done":
+        raise ValueError("Unexpected end of JSON array")
+
+
+def parse_csv_line(line: str) -> Optional[List[str]]:
+    """Разобрать строку mapping.csv
+
+    Файл генерируется auto_map.sh без экранирования кавычек внутри полей
+    ("Экстракт "Golden Reishi""), поэтому строки вида "a","b","c","d"
+    делятся по разделителю "," напрямую.
+    """
+    line = line.strip()
+    if not line:
+        return None
+    if line.startswith('"') and line.endswith('"') and line.count('","') == len(MAPPING_FIELDS) - 1:
+        return line[1:-1].split('","')
+    return next(csv.reader([line]))
+
+
+def validate_row(values: Dict) -> Tuple[Optional[Dict], Optional[str]]:
+    """Проверить запись маппинга; возвращает (запись, None) или (None, причина)"""
+    row = {field: str(values.get(field) or "").strip() for field in MAPPING_FIELDS}
+    missing = [field for field in ("bitrix24_product_id", "onec_product_code") if not row[field]]
+    if missing:
+        return None, f"Missing {', '.join(missing)}"
+    for field in ("bitrix24_product_id", "onec_product_code"):
+        if len(row[field]) > 100:
+            return None, f"{field} is too long"
+    for field in ("bitrix24_product_name", "onec_product_name"):
+        row[field] = row[field][:500]
+    return row, None
+
+
+async def upsert_mappings(session: AsyncSession, rows: List[Dict]) -> Tuple[int, int]:
+    """Вставить или обновить пачку маппингов одним INSERT ... ON CONFLICT
+
+    Возвращает (создано, обновлено). Строки с одинаковым bitrix24_product_id
+    внутри пачки должны быть схлопнуты заранее.
+    """
+    now = datetime.utcnow()
+    stmt = insert(ProductMapping).values([{**row, "created_at": now, "updated_at": now} for row in rows])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ProductMapping.bitrix24_product_id],
+        set_={
+            "bitrix24_product_name": stmt.excluded.bitrix24_product_name,
+            "onec_product_code": stmt.excluded.onec_product_code,
+            "onec_product_name": stmt.excluded.onec_product_name,
+            "updated_at": now
+        }
+    ).returning(literal_column("xmax = 0").label("inserted"))
+    result = await session.execute(stmt)
+    inserted = [row.inserted for row in result]
+    created = sum(1 for flag in inserted if flag)
+    return created, len(inserted) - created
@@ -0,0 +1,148 @@
+"""Индекс маппинга товаров в памяти процесса"""
+import asyncio
+import asyncpg
+from typing import Dict, List, Optional, Set
+from loguru import logger
+from sqlalchemy import select, text, func, cast, BigInteger, Text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import async_session_maker, asyncpg_dsn, ProductMapping, SyncState
+
+
+class ProductMappingIndex:
+    """Двунаправленный индекс маппинга: ID товара Bitrix24 <-> код 1С
+
+    Загружается целиком один раз и перечитывается при изменениях маппинга.
+    Изменения между воркерами uvicorn рассылаются через Postgres LISTEN/NOTIFY.
+    """
+
+    CHANNEL = "bitrix_1c_product_mapping_changed"
+    # Ключ SyncState: номер версии маппинга, растёт при каждом изменении (для ETag)
+    VERSION_KEY = "product_mapping_version"
+
+    def __init__(self):
+        self.loaded = False
+        self._by_bitrix24: Dict[str, Dict] = {}
+        self._by_onec: Dict[str, List[Dict]] = {}
+        self._reload_lock = asyncio.Lock()
+        self._reload_pending = False
+        self._reload_tasks: Set[asyncio.Task] = set()
+        self._listener_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._by_bitrix24)
+
+    @staticmethod
+    def _as_dict(mapping: ProductMapping) -> Dict:
+        return {
+            "bitrix24_product_id": mapping.bitrix24_product_id,
+            "bitrix24_product_name": mapping.bitrix24_product_name,
+            "onec_product_code": mapping.onec_product_code,
+            "onec_product_name": mapping.onec_product_name
+        }
+
+    def _rebuild(self, mappings: List[Dict]):
+        by_bitrix24 = {}
+        by_onec: Dict[str, List[Dict]] = {}
+        for mapping in mappings:
+            by_bitrix24[mapping["bitrix24_product_id"]] = mapping
+            by_onec.setdefault(mapping["onec_product_code"], []).append(mapping)
+        self._by_bitrix24, self._by_onec = by_bitrix24, by_onec
+
+    async def load(self):
+        """Загрузить маппинг из БД (параллельные запросы на перезагрузку схлопываются)"""
+        self._reload_pending = True
+        async with self._reload_lock:
+            if not self._reload_pending:
+                return
+            self._reload_pending = False
+            async with async_session_maker() as session:
+                result = await session.execute(select(ProductMapping))
+                self._rebuild([self._as_dict(m) for m in result.scalars()])
+            self.loaded = True
+            logger.info(f"Product mapping index loaded: {len(self)} items")
+
+    async def ensure_loaded(self):
+        if not self.loaded:
+            await self.load()
+
+    def by_bitrix24(self, product_id: str) -> Optional[Dict]:
+        """Маппинг по ID товара Bitrix24"""
+        return self._by_bitrix24.get(str(product_id))
+
+    def by_onec(self, product_code: str) -> List[Dict]:
+        """Все маппинги для кода номенклатуры 1С"""
+        return self._by_onec.get(product_code, [])
+
+    def onec_codes(self) -> List[str]:
+        """Все коды номенклатуры 1С, сопоставленные с товарами Bitrix24"""
+        return list(self._by_onec)
+
+    def put(self, mapping: Dict):
+        """Обновить запись локально, не дожидаясь уведомления"""
+        mappings = [m for m in self._by_bitrix24.values() if m["bitrix24_product_id"] != mapping["bitrix24_product_id"]]
+        mappings.append(mapping)
+        self._rebuild(mappings)
+
+    async def notify_changed(self, session: AsyncSession):
+        """Уведомить все процессы об изменении маппинга и увеличить версию (применяется при commit)"""
+        stmt = insert(SyncState).values(key=self.VERSION_KEY, value="1", updated_at=func.now())
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[SyncState.key],
+            set_={"value": cast(cast(SyncState.value, BigInteger) + 1, Text), "updated_at": func.now()}
+        ))
+        await session.execute(text("SELECT pg_notify(:channel, '')"), {"channel": self.CHANNEL})
+
+    async def version(self, session: AsyncSession) -> str:
+        """Текущая версия маппинга (одна строка по первичному ключу)"""
+        result = await session.execute(select(SyncState.value).where(SyncState.key == self.VERSION_KEY))
+        return result.scalar_one_or_none() or "0"
+
+    def _on_notification(self, connection, pid, channel, payload):
+        # Цикл событий держит задачи по слабой ссылке: сильную хранит индекс до завершения
+        task = asyncio.create_task(self.load())
+        self._reload_tasks.add(task)
+        task.add_done_callback(self._on_reload_done)
+
+    def _on_reload_done(self, task: asyncio.Task):
+        self._reload_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Product mapping reload failed: {task.exception()}")
+
+    async def _listen(self):
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(asyncpg_dsn)
+                await connection.add_listener(self.CHANNEL, self._on_notification)
+                # Уведомления, пришедшие до подписки, могли быть пропущены
+                await self.load()
+                while not connection.is_closed():
+                    await asyncio.sleep(30)
+                logger.warning("Product mapping listener connection lost")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Product mapping listener error: {e}")
+            finally:
+                if connection and not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(5)
+
+    def start_listener(self):
+        """Подписаться на изменения маппинга из других процессов"""
+        if self._listener_task and not self._listener_task.done():
+            return
+        self._listener_task = asyncio.create_task(self._listen())
+
+    async def stop_listener(self):
+        if self._listener_task:
+            self._listener_task.cancel()
+            try:
+                await self._listener_task
+            except asyncio.CancelledError:
+                pass
+            self._listener_task = None
+
+
+mapping_index = ProductMappingIndex()
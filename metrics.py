@@ -0,0 +1,152 @@
+"""Метрики приложения в формате Prometheus
+
+Метрики хранятся в памяти процесса. При нескольких воркерах uvicorn нужно
+задать PROMETHEUS_MULTIPROC_DIR (пустой каталог, очищаемый при старте
+контейнера): тогда /metrics отдаёт сумму по всем воркерам контейнера.
+Контейнеры по-прежнему опрашиваются каждый отдельно.
+"""
+import os
+import re
+import time
+from urllib.parse import unquote
+import httpx
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+from sqlalchemy import select, func
+from database import async_session_maker, DealJob
+
+
+UPSTREAM_LATENCY = Histogram(
+    "upstream_request_duration_seconds",
+    "Время запроса к внешнему сервису до получения заголовков ответа",
+    ["upstream", "method"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+UPSTREAM_ERRORS = Counter(
+    "upstream_request_errors_total",
+    "Ошибки запросов к внешним сервисам: HTTP статус или тип исключения",
+    ["upstream", "status"]
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "upstream_requests_in_flight",
+    "Запросы к внешним сервисам, ожидающие ответа",
+    ["upstream"],
+    multiprocess_mode="livesum"
+)
+UPSTREAM_RETRIES = Counter(
+    "upstream_request_retries_total",
+    "Повторы запросов к внешним сервисам",
+    ["upstream"]
+)
+UPSTREAM_CIRCUIT_OPEN = Gauge(
+    "upstream_circuit_open",
+    "Автомат отключения сервиса разомкнут (1) или замкнут (0)",
+    ["upstream"],
+    multiprocess_mode="livemax"
+)
+UPSTREAM_CONCURRENCY_LIMIT = Gauge(
+    "upstream_concurrency_limit",
+    "Текущий адаптивный лимит параллельных запросов",
+    ["upstream"],
+    multiprocess_mode="liveall"
+)
+DEAL_JOB_QUEUE = Gauge(
+    "deal_job_queue_depth",
+    "Задачи обработки сделок в очереди и в работе",
+    ["status"],
+    multiprocess_mode="mostrecent"
+)
+SCHEDULER_LEADER = Gauge(
+    "scheduler_leader",
+    "Экземпляр выполняет плановые задачи (1) или ожидает (0)",
+    multiprocess_mode="livemax"
+)
+STOCK_SYNC_DURATION = Histogram(
+    "stock_sync_duration_seconds",
+    "Длительность синхронизации остатков 1С -> Bitrix24",
+    ["mode", "status"],
+    buckets=(5, 15, 30, 60, 120, 300, 600, 1200, 1800)
+)
+STOCK_SYNC_ITEMS = Counter(
+    "stock_sync_items_total",
+    "Позиции остатков, обработанные синхронизацией",
+    ["result"]
+)
+STOCK_SYNC_LAST_SUCCESS = Gauge(
+    "stock_sync_last_success_timestamp_seconds",
+    "Время окончания последней успешной синхронизации остатков",
+    multiprocess_mode="max"
+)
+
+# Статусы задач, составляющие очередь (done/dead только растут и в выборку не входят)
+QUEUE_STATUSES = ("pending", "processing")
+
+# Путь сущности OData 1С: всё после standard.odata/ без ключей в скобках
+ODATA_MARKER = "/standard.odata/"
+
+
+def upstream_method(url: httpx.URL) -> str:
+    """Метка метода по URL запроса
+
+    Для 1С — сущность OData, для остальных — последний сегмент пути
+    (в начале пути Bitrix24 и Telegram лежат токены, они в метки не попадают).
+    """
+    path = unquote(url.path)
+    if ODATA_MARKER in path:
+        return re.sub(r"\(.*?\)", "", path.split(ODATA_MARKER, 1)[1])
+    return path.rstrip("/").rsplit("/", 1)[-1]
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """Транспорт httpx, считающий время, ошибки и число запросов в полёте"""
+    
+    def __init__(self, upstream: str, transport: httpx.AsyncBaseTransport):
+        self.upstream = upstream
+        self._transport = transport
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        in_flight = UPSTREAM_IN_FLIGHT.labels(self.upstream)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except Exception as e:
+            UPSTREAM_ERRORS.labels(self.upstream, type(e).__name__).inc()
+            raise
+        finally:
+            in_flight.dec()
+            UPSTREAM_LATENCY.labels(self.upstream, upstream_method(request.url)).observe(time.perf_counter() - started)
+        
+        if response.status_code >= 400:
+            UPSTREAM_ERRORS.labels(self.upstream, str(response.status_code)).inc()
+        return response
+    
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+async def collect_queue_depth():
+    """Обновить глубину очереди сделок перед отдачей метрик"""
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(DealJob.status, func.count())
+            .where(DealJob.status.in_(QUEUE_STATUSES))
+            .group_by(DealJob.status)
+        )
+        counts = dict(result.all())
+    for status in QUEUE_STATUSES:
+        DEAL_JOB_QUEUE.labels(status).set(counts.get(status, 0))
+
+
+def metrics_registry() -> CollectorRegistry:
+    """Реестр для /metrics: в режиме multiprocess — сумма по всем воркерам"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def mark_process_dead():
+    """Убрать live-метрики завершающегося воркера из режима multiprocess"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,113 @@
+"""Кэш номенклатуры 1С"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+from loguru import logger
+from config import settings
+
+
+class NomenclatureIndex:
+    """Индекс номенклатуры 1С: Code -> Ref_Key, СтавкаНДС_Key, Description
+
+    Заполняется целиком постраничной выгрузкой справочника и периодически
+    обновляется в фоне. Записи живут ttl секунд, при переполнении
+    вытесняются давно не использованные (LRU).
+    """
+
+    def __init__(self, ttl: int, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.loaded_at: Optional[float] = None
+        self._by_code: "OrderedDict[str, Dict]" = OrderedDict()
+        self._by_ref: Dict[str, str] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._by_code)
+
+    def _remove(self, code: str):
+        entry = self._by_code.pop(code, None)
+        if entry and self._by_ref.get(entry["ref_key"]) == code:
+            del self._by_ref[entry["ref_key"]]
+
+    def _is_expired(self, entry: Dict) -> bool:
+        return time.monotonic() - entry["cached_at"] > self.ttl
+
+    def get(self, code: str) -> Optional[Dict]:
+        """Запись по коду номенклатуры или None, если её нет или она устарела"""
+        entry = self._by_code.get(code)
+        if entry is None:
+            return None
+        if self._is_expired(entry):
+            self._remove(code)
+            return None
+        self._by_code.move_to_end(code)
+        return entry
+
+    def get_by_ref(self, ref_key: str) -> Optional[Dict]:
+        """Запись по Ref_Key номенклатуры"""
+        code = self._by_ref.get(ref_key)
+        return self.get(code) if code is not None else None
+
+    def put(self, entry: Dict, cached_at: float = None):
+        """Добавить или обновить запись {code, ref_key, nds_key, name}"""
+        code = entry["code"]
+        self._remove(code)
+        self._by_code[code] = {**entry, "cached_at": cached_at or time.monotonic()}
+        self._by_ref[entry["ref_key"]] = code
+        while len(self._by_code) > self.max_size:
+            oldest = next(iter(self._by_code))
+            self._remove(oldest)
+
+    def replace(self, entries: List[Dict]):
+        """Заменить содержимое индекса полной выгрузкой"""
+        if len(entries) > self.max_size:
+            logger.warning(f"Nomenclature index truncated: {len(entries)} items, max size {self.max_size}")
+        now = time.monotonic()
+        self._by_code.clear()
+        self._by_ref.clear()
+        for entry in entries:
+            self.put(entry, cached_at=now)
+        self.loaded_at = now
+
+    def invalidate(self, code: str = None):
+        """Сбросить одну запись или весь индекс"""
+        if code is not None:
+            self._remove(code)
+            return
+        self._by_code.clear()
+        self._by_ref.clear()
+        self.loaded_at = None
+        logger.info("Nomenclature index invalidated")
+
+    def start_background_refresh(self, refresh: Callable[[], Awaitable], interval: int):
+        """Запустить фоновое обновление: сразу и затем каждые interval секунд"""
+        if self._refresh_task and not self._refresh_task.done():
+            return
+
+        async def _loop():
+            while True:
+                try:
+                    await refresh()
+                except Exception as e:
+                    logger.error(f"Nomenclature index refresh failed: {e}")
+                await asyncio.sleep(interval)
+
+        self._refresh_task = asyncio.create_task(_loop())
+
+    async def stop_background_refresh(self):
+        """Остановить фоновое обновление"""
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+
+
+nomenclature_index = NomenclatureIndex(
+    ttl=settings.nomenclature_cache_ttl,
+    max_size=settings.nomenclature_cache_max_size
+)
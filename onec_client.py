@@ -1,12 +1,46 @@
 """Клиент для работы с 1С через OData"""
+import asyncio
 import httpx
 import re
-from typing import Dict, List, Optional
+from html import unescape
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import quote
 from loguru import logger
 from config import settings
+from http_clients import http_clients
+from upstream_scheduler import CircuitOpenError, REJECTED_STATUSES
+from nomenclature_index import nomenclature_index
+import counterparty_index
+from leader_election import advisory_lock, LOCK_COUNTERPARTY_BACKFILL
 from datetime import datetime
 
 
+ODATA_SAFE_CHARS = "',()="
+# Ошибки, при которых запрос точно не дошёл до 1С
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, CircuitOpenError)
+
+
+def _odata_query(query: Dict[str, str]) -> str:
+    """Собрать строку запроса OData (пробелы кодируются как %20, а не '+')"""
+    return "&".join(f"{key}={quote(str(value), safe=ODATA_SAFE_CHARS)}" for key, value in query.items())
+
+
+def _odata_literal(value: str) -> str:
+    """Строковый литерал OData"""
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _parse_entries(xml_text: str) -> List[Dict[str, str]]:
+    """Разобрать свойства записей Atom-ответа OData"""
+    entries = []
+    for block in re.findall(r'<m:properties>(.*?)</m:properties>', xml_text, re.S):
+        entries.append({
+            name: unescape(value)
+            for name, value in re.findall(r'<d:([^\s>/]+)(?:\s[^>]*)?>([^<]*)</d:\1>', block)
+        })
+    return entries
+
+
 class OneCClient:
     ORGANIZATION_KEY = "156d4f37-4e45-11ea-8d1d-84a93e69ebd9"
     WAREHOUSE_KEY = "1b77d3ec-4e45-11ea-8d1d-84a93e69ebd9"
@@ -14,13 +48,21 @@ class OneCClient:
     UNIT_KEY = "1b77d40c-4e45-11ea-8d1d-84a93e69ebd9"
     DEFAULT_KONTRAGENT_KEY = "4ebe3b87-c5f6-11f0-9902-c8d9d2344d9e"
     DEFAULT_NDS_KEY = "156d4f18-4e45-11ea-8d1d-84a93e69ebd9"  # Ставка НДС
+    NOMENCLATURE_FILTER_CHUNK = 20
+    SALES_DOCUMENT_PATH = "Document_%D0%A0%D0%B5%D0%B0%D0%BB%D0%B8%D0%B7%D0%B0%D1%86%D0%B8%D1%8F%D0%A2%D0%BE%D0%B2%D0%B0%D1%80%D0%BE%D0%B2%D0%A3%D1%81%D0%BB%D1%83%D0%B3"
+    STOCK_REGISTER_PATH = "AccumulationRegister_%D0%A2%D0%BE%D0%B2%D0%B0%D1%80%D1%8B%D0%9E%D1%80%D0%B3%D0%B0%D0%BD%D0%B8%D0%B7%D0%B0%D1%86%D0%B8%D0%B9%D0%91%D0%A3"
+    STOCK_MOVEMENTS_PATH = f"{STOCK_REGISTER_PATH}_RecordType"
+    KONTRAGENT_PATH = "Catalog_%D0%9A%D0%BE%D0%BD%D1%82%D1%80%D0%B0%D0%B3%D0%B5%D0%BD%D1%82%D1%8B"
+    NOMENCLATURE_PATH = "Catalog_%D0%9D%D0%BE%D0%BC%D0%B5%D0%BD%D0%BA%D0%BB%D0%B0%D1%82%D1%83%D1%80%D0%B0"
     
     def __init__(self):
         self.base_url = settings.onec_base_url.rstrip('/')
         self.username = settings.onec_username
         self.password = settings.onec_password
         self.odata_url = f"{self.base_url}/odata/standard.odata"
-        self.client = httpx.AsyncClient(timeout=60.0, auth=(self.username, self.password))
+        shared = http_clients.get("onec")
+        self._owns_client = shared is None
+        self.client = shared or httpx.AsyncClient(timeout=60.0, auth=(self.username, self.password))
     
     async def create_order(self, order_data: Dict) -> Dict:
         deal_id = order_data.get('deal_id', 'unknown')
@@ -34,6 +76,9 @@ class OneCClient:
         customer_phone = customer.get('phone', '')
         kontragent_key = await self._find_or_create_kontragent(customer_name, customer_phone)
         
+        # Номенклатура с НДС для всех строк заказа за один проход
+        nomenclature = await self._resolve_nomenclature([product.get('code', '') for product in products])
+        
         products_xml = ""
         for i, product in enumerate(products, 1):
             product_code = product.get('code', '')
@@ -41,8 +86,7 @@ class OneCClient:
             price = product.get('price', 0)
             sum_val = quantity * price
             
-            # Получаем номенклатуру с НДС
-            nom_data = await self._get_nomenclature_with_nds(product_code)
+            nom_data = nomenclature.get(product_code)
             if not nom_data:
                 logger.warning(f"Nomenclature not found for code: {product_code}")
                 continue
@@ -67,7 +111,7 @@ class OneCClient:
           <d:СуммаНДС>{sum_nds}</d:СуммаНДС>
         </d:element>'''
         
-        comment = f"Bitrix24 сделка {deal_id}: {customer_name} {customer_phone}"
+        comment = f"{self._order_comment_prefix(deal_id)} {customer_name} {customer_phone}"
         
         xml_data = f'''<?xml version="1.0" encoding="utf-8"?>
 <entry xmlns="http://www.w3.org/2005/Atom" xmlns:d="http://schemas.microsoft.com/ado/2007/08/dataservices" xmlns:m="http://schemas.microsoft.com/ado/2007/08/dataservices/metadata">
@@ -89,7 +133,7 @@ class OneCClient:
   </content>
 </entry>'''
         
-        url = f"{self.odata_url}/Document_%D0%A0%D0%B5%D0%B0%D0%BB%D0%B8%D0%B7%D0%B0%D1%86%D0%B8%D1%8F%D0%A2%D0%BE%D0%B2%D0%B0%D1%80%D0%BE%D0%B2%D0%A3%D1%81%D0%BB%D1%83%D0%B3"
+        url = f"{self.odata_url}/{self.SALES_DOCUMENT_PATH}"
         headers = {"Content-Type": "application/atom+xml;type=entry;charset=utf-8", "Accept": "application/atom+xml"}
         
         try:
@@ -101,10 +145,32 @@ class OneCClient:
                 return {"success": True, "order_number": order_number, "order_id": order_id, "message": f"Накладная {order_number} создана"}
             else:
                 logger.error(f"Failed: {response.status_code} - {response.text[:300]}")
-                return {"success": False, "message": f"Ошибка: {response.status_code}"}
+                # 5xx не означает, что документ не записан: перед повтором его нужно поискать
+                ambiguous = response.status_code >= 500 and response.status_code not in REJECTED_STATUSES
+                return {"success": False, "ambiguous": ambiguous, "message": f"Ошибка: {response.status_code}"}
         except Exception as e:
             logger.error(f"Error: {e}")
-            return {"success": False, "message": str(e)}
+            # Таймаут чтения или обрыв: 1С мог создать документ
+            ambiguous = isinstance(e, httpx.TransportError) and not isinstance(e, NOT_SENT_ERRORS)
+            return {"success": False, "ambiguous": ambiguous, "message": str(e)}
+    
+    @staticmethod
+    def _order_comment_prefix(deal_id: str) -> str:
+        return f"Bitrix24 сделка {deal_id}:"
+    
+    async def find_order(self, deal_id: str) -> Optional[Dict]:
+        """Документ реализации, созданный для сделки (поиск по комментарию)"""
+        query = _odata_query({
+            "$filter": f"DeletionMark eq false and substringof({_odata_literal(self._order_comment_prefix(deal_id))},Комментарий)",
+            "$select": "Ref_Key,Number",
+            "$top": 1
+        })
+        response = await self.client.get(f"{self.odata_url}/{self.SALES_DOCUMENT_PATH}?{query}")
+        response.raise_for_status()
+        entries = _parse_entries(response.text)
+        if not entries:
+            return None
+        return {"order_number": entries[0].get('Number'), "order_id": entries[0].get('Ref_Key')}
     
     def _parse_order_number(self, xml_text: str) -> Optional[str]:
         match = re.search(r'<d:Number>([^<]+)</d:Number>', xml_text)
@@ -124,12 +190,23 @@ class OneCClient:
         phone_search = phone_digits[-10:]
         
         try:
-            url = f"{self.odata_url}/Catalog_%D0%9A%D0%BE%D0%BD%D1%82%D1%80%D0%B0%D0%B3%D0%B5%D0%BD%D1%82%D1%8B?$filter=substringof('{phone_search}',Комментарий)&$select=Ref_Key&$top=1"
+            ref_key = await counterparty_index.find_counterparty(phone)
+            if ref_key:
+                logger.info(f"Found kontragent by phone in local index")
+                return ref_key
+        except Exception as e:
+            logger.error(f"Error reading counterparty index: {e}")
+        
+        # Промах индекса не доказывает, что контрагента нет в 1С: выгрузка знает
+        # только формат "Телефон: ...", а контрагентов добавляют и вручную
+        try:
+            url = f"{self.odata_url}/{self.KONTRAGENT_PATH}?$filter=substringof('{phone_search}',Комментарий)&$select=Ref_Key&$top=1"
             response = await self.client.get(url)
             if response.status_code == 200 and 'Ref_Key' in response.text:
                 match = re.search(r'<d:Ref_Key>([^<]+)</d:Ref_Key>', response.text)
                 if match:
                     logger.info(f"Found kontragent by phone")
+                    await self._remember_kontragent(phone, match.group(1))
                     return match.group(1)
             
             logger.info(f"Creating new kontragent: {name}")
@@ -152,7 +229,7 @@ class OneCClient:
   </content>
 </entry>'''
             
-            url = f"{self.odata_url}/Catalog_%D0%9A%D0%BE%D0%BD%D1%82%D1%80%D0%B0%D0%B3%D0%B5%D0%BD%D1%82%D1%8B"
+            url = f"{self.odata_url}/{self.KONTRAGENT_PATH}"
             headers = {"Content-Type": "application/atom+xml;type=entry;charset=utf-8", "Accept": "application/atom+xml"}
             response = await self.client.post(url, content=xml_data.encode('utf-8'), headers=headers)
             
@@ -160,35 +237,326 @@ class OneCClient:
                 match = re.search(r"guid'([^']+)'", response.text)
                 if match:
                     logger.info(f"Created kontragent: {match.group(1)}")
+                    await self._remember_kontragent(phone, match.group(1))
                     return match.group(1)
             return self.DEFAULT_KONTRAGENT_KEY
         except Exception as e:
             logger.error(f"Error creating kontragent: {e}")
             return self.DEFAULT_KONTRAGENT_KEY
     
-    async def _get_nomenclature_with_nds(self, product_code: str) -> Optional[Dict]:
-        """Получить номенклатуру с НДС"""
+    async def _remember_kontragent(self, phone: str, ref_key: str):
         try:
-            url = f"{self.odata_url}/Catalog_%D0%9D%D0%BE%D0%BC%D0%B5%D0%BD%D0%BA%D0%BB%D0%B0%D1%82%D1%83%D1%80%D0%B0?$filter=Code%20eq%20%27{product_code}%27&$select=Ref_Key,СтавкаНДС_Key"
-            response = await self.client.get(url)
-            if response.status_code == 200 and 'Ref_Key' in response.text:
-                ref_match = re.search(r'<d:Ref_Key>([^<]+)</d:Ref_Key>', response.text)
-                nds_match = re.search(r'<d:СтавкаНДС_Key>([^<]+)</d:СтавкаНДС_Key>', response.text)
-                if ref_match:
-                    return {
-                        'ref_key': ref_match.group(1),
-                        'nds_key': nds_match.group(1) if nds_match else self.DEFAULT_NDS_KEY
-                    }
-            return None
+            await counterparty_index.remember_counterparty(phone, ref_key)
         except Exception as e:
-            logger.error(f"Error: {e}")
-            return None
+            logger.error(f"Error saving counterparty index: {e}")
+    
+    async def iter_kontragent_phones(self) -> AsyncIterator[Dict[str, str]]:
+        """Постранично выгрузить телефоны контрагентов: {телефон: Ref_Key} на страницу"""
+        page_size = settings.onec_page_size
+        skip = 0
+        while True:
+            query = _odata_query({
+                "$filter": "IsFolder eq false",
+                "$select": "Ref_Key,Комментарий",
+                "$orderby": "Ref_Key",
+                "$top": page_size,
+                "$skip": skip
+            })
+            response = await self.client.get(f"{self.odata_url}/{self.KONTRAGENT_PATH}?{query}")
+            response.raise_for_status()
+            page = _parse_entries(response.text)
+            
+            phones = {}
+            for props in page:
+                match = re.search(r'Телефон:\s*([^|]+)', props.get('Комментарий', ''))
+                if match and props.get('Ref_Key'):
+                    phones[match.group(1).strip()] = props['Ref_Key']
+            yield phones
+            
+            if len(page) < page_size:
+                break
+            skip += page_size
+    
+    def _nomenclature_entry(self, props: Dict[str, str]) -> Dict:
+        return {
+            'code': props.get('Code', '').strip(),
+            'ref_key': props['Ref_Key'],
+            'nds_key': props.get('СтавкаНДС_Key') or self.DEFAULT_NDS_KEY,
+            'name': props.get('Description', '')
+        }
+    
+    async def load_nomenclature(self) -> List[Dict]:
+        """Выгрузить весь справочник номенклатуры постранично"""
+        page_size = settings.onec_page_size
+        entries = []
+        skip = 0
+        while True:
+            query = _odata_query({
+                "$filter": "IsFolder eq false",
+                "$select": "Ref_Key,Code,Description,СтавкаНДС_Key",
+                "$orderby": "Ref_Key",
+                "$top": page_size,
+                "$skip": skip
+            })
+            response = await self.client.get(f"{self.odata_url}/{self.NOMENCLATURE_PATH}?{query}")
+            response.raise_for_status()
+            page = [props for props in _parse_entries(response.text) if props.get('Ref_Key')]
+            entries.extend(self._nomenclature_entry(props) for props in page)
+            if len(page) < page_size:
+                break
+            skip += page_size
+        return entries
+    
+    async def _fetch_nomenclature(self, filter_expr: str) -> List[Dict]:
+        """Запросить номенклатуру одним $filter"""
+        query = _odata_query({
+            "$filter": filter_expr,
+            "$select": "Ref_Key,Code,Description,СтавкаНДС_Key"
+        })
+        response = await self.client.get(f"{self.odata_url}/{self.NOMENCLATURE_PATH}?{query}")
+        response.raise_for_status()
+        return [self._nomenclature_entry(props) for props in _parse_entries(response.text) if props.get('Ref_Key')]
+    
+    async def _resolve_nomenclature(self, codes: List[str]) -> Dict[str, Dict]:
+        """Получить номенклатуру с НДС для набора кодов
+        
+        Коды из индекса берутся без обращения к 1С, остальные запрашиваются
+        пачками по NOMENCLATURE_FILTER_CHUNK кодов параллельно.
+        """
+        resolved = {}
+        missing = []
+        for code in dict.fromkeys(codes):
+            cached = nomenclature_index.get(code)
+            if cached:
+                resolved[code] = cached
+            else:
+                missing.append(code)
+        
+        if not missing:
+            return resolved
+        
+        semaphore = asyncio.Semaphore(settings.onec_max_concurrency)
+        
+        async def _fetch_chunk(chunk: List[str]) -> List[Dict]:
+            async with semaphore:
+                try:
+                    return await self._fetch_nomenclature(
+                        " or ".join(f"Code eq {_odata_literal(code)}" for code in chunk)
+                    )
+                except Exception as e:
+                    logger.error(f"Error fetching nomenclature {chunk}: {e}")
+                    return []
+        
+        chunks = [missing[i:i + self.NOMENCLATURE_FILTER_CHUNK] for i in range(0, len(missing), self.NOMENCLATURE_FILTER_CHUNK)]
+        for entries in await asyncio.gather(*(_fetch_chunk(chunk) for chunk in chunks)):
+            for entry in entries:
+                if entry['code'] in missing and entry['code'] not in resolved:
+                    nomenclature_index.put(entry)
+                    resolved[entry['code']] = entry
+        
+        return resolved
+    
+    async def _resolve_nomenclature_refs(self, ref_keys: List[str]) -> Dict[str, Dict]:
+        """Получить номенклатуру по набору Ref_Key (индекс, затем пачками из 1С)
+        
+        Ошибка запроса не пропускается: товар, выпавший из выгрузки остатков,
+        синхронизация сочла бы распроданным.
+        """
+        resolved = {}
+        missing = []
+        for ref_key in dict.fromkeys(ref_keys):
+            cached = nomenclature_index.get_by_ref(ref_key)
+            if cached:
+                resolved[ref_key] = cached
+            else:
+                missing.append(ref_key)
+        
+        for i in range(0, len(missing), self.NOMENCLATURE_FILTER_CHUNK):
+            chunk = missing[i:i + self.NOMENCLATURE_FILTER_CHUNK]
+            entries = await self._fetch_nomenclature(
+                " or ".join(f"Ref_Key eq guid'{ref_key}'" for ref_key in chunk)
+            )
+            for entry in entries:
+                if entry['code']:
+                    nomenclature_index.put(entry)
+                resolved[entry['ref_key']] = entry
+        
+        return resolved
+    
+    async def _get_nomenclature_with_nds(self, product_code: str) -> Optional[Dict]:
+        """Получить номенклатуру с НДС (сначала из индекса, затем из 1С)"""
+        resolved = await self._resolve_nomenclature([product_code])
+        return resolved.get(product_code)
+    
+    def _balance_url(self, warehouse: str = None, ref_keys: List[str] = None) -> str:
+        """URL виртуальной таблицы остатков с группировкой по товару"""
+        params = ["Dimensions='Товар'"]
+        conditions = []
+        if warehouse:
+            conditions.append(f"Склад_Key eq guid'{warehouse}'")
+        if ref_keys:
+            conditions.append(" or ".join(f"Товар_Key eq guid'{ref_key}'" for ref_key in ref_keys))
+        if conditions:
+            condition = conditions[0] if len(conditions) == 1 else " and ".join(f"({c})" for c in conditions)
+            params.append(f"Condition={_odata_literal(condition)}")
+        return f"{self.odata_url}/{self.STOCK_REGISTER_PATH}/Balance({quote(','.join(params), safe=ODATA_SAFE_CHARS)})"
+    
+    async def _fetch_balance_page(self, warehouse: Optional[str], skip: int) -> List[Dict[str, str]]:
+        query = _odata_query({
+            "$select": "Товар_Key,КоличествоBalance",
+            "$orderby": "Товар_Key",
+            "$top": settings.onec_page_size,
+            "$skip": skip
+        })
+        response = await self.client.get(f"{self._balance_url(warehouse)}?{query}")
+        response.raise_for_status()
+        return _parse_entries(response.text)
+    
+    async def _balance_items(self, page: List[Dict[str, str]], warehouse: Optional[str]) -> List[Dict]:
+        """Преобразовать страницу остатков в позиции с кодом и названием номенклатуры"""
+        nomenclature = await self._resolve_nomenclature_refs([row['Товар_Key'] for row in page if row.get('Товар_Key')])
+        
+        items = []
+        for row in page:
+            entry = nomenclature.get(row.get('Товар_Key'))
+            if not entry or not entry['code']:
+                logger.warning(f"Nomenclature not found for Ref_Key: {row.get('Товар_Key')}")
+                continue
+            item = {
+                "ref_key": row['Товар_Key'],
+                "product_code": entry['code'],
+                "product_name": entry['name'],
+                "quantity": int(float(row.get('КоличествоBalance') or 0))
+            }
+            if warehouse:
+                item["warehouse"] = warehouse
+            items.append(item)
+        return items
+    
+    async def get_stock_balances(self, warehouse: str = None) -> AsyncIterator[Dict]:
+        """Остатки товаров из регистра ТоварыОрганизацийБУ
+        
+        Постранично читает виртуальную таблицу Balance и отдаёт позиции по мере
+        загрузки; следующая страница запрашивается, пока обрабатывается текущая.
+        """
+        page_size = settings.onec_page_size
+        skip = 0
+        next_page = asyncio.create_task(self._fetch_balance_page(warehouse, skip))
+        try:
+            while True:
+                page = await next_page
+                next_page = None
+                if len(page) == page_size:
+                    skip += page_size
+                    next_page = asyncio.create_task(self._fetch_balance_page(warehouse, skip))
+                
+                for item in await self._balance_items(page, warehouse):
+                    yield item
+                
+                if next_page is None:
+                    break
+        finally:
+            if next_page and not next_page.done():
+                next_page.cancel()
+    
+    async def get_latest_movement_period(self) -> Optional[datetime]:
+        """Период последнего движения регистра остатков (по часам 1С)"""
+        query = _odata_query({"$select": "Period", "$orderby": "Period desc", "$top": 1})
+        response = await self.client.get(f"{self.odata_url}/{self.STOCK_MOVEMENTS_PATH}?{query}")
+        response.raise_for_status()
+        entries = _parse_entries(response.text)
+        return datetime.fromisoformat(entries[0]['Period']) if entries else None
     
-    async def get_stock_balances(self, warehouse: str = None) -> List[Dict]:
-        return []
+    async def get_moved_products(self, since: datetime) -> Tuple[List[str], Optional[datetime]]:
+        """Ref_Key товаров с движениями регистра остатков после since и период последнего движения
+
+        Страницы читаются курсором по Period (Period ge период последней строки),
+        а не сквозным $skip: новые движения внутри окна не сдвигают уже
+        прочитанные строки. Строки на границе страниц читаются повторно, что
+        безопасно для множества товаров; $skip нужен только, если вся страница
+        приходится на один период.
+        """
+        page_size = settings.onec_page_size
+        ref_keys: Dict[str, None] = {}
+        last_period = None
+        cursor, operator, skip = since, "gt", 0
+        while True:
+            query = _odata_query({
+                "$filter": f"Period {operator} datetime'{cursor.isoformat(timespec='seconds')}'",
+                "$select": "Period,Товар_Key",
+                "$orderby": "Period,Recorder,LineNumber",
+                "$top": page_size,
+                "$skip": skip
+            })
+            response = await self.client.get(f"{self.odata_url}/{self.STOCK_MOVEMENTS_PATH}?{query}")
+            response.raise_for_status()
+            page = _parse_entries(response.text)
+            for row in page:
+                if row.get('Товар_Key'):
+                    ref_keys[row['Товар_Key']] = None
+                if row.get('Period'):
+                    last_period = max(last_period or since, datetime.fromisoformat(row['Period']))
+            if len(page) < page_size:
+                break
+            page_end = datetime.fromisoformat(page[-1]['Period'])
+            if operator == "ge" and page_end == cursor:
+                skip += page_size
+            else:
+                cursor, operator, skip = page_end, "ge", 0
+        return list(ref_keys), last_period
+    
+    async def get_stock_balances_for(self, ref_keys: List[str], warehouse: str = None) -> List[Dict]:
+        """Остатки набора товаров; товар без строки в Balance имеет нулевой остаток"""
+        items = []
+        for i in range(0, len(ref_keys), self.NOMENCLATURE_FILTER_CHUNK):
+            chunk = ref_keys[i:i + self.NOMENCLATURE_FILTER_CHUNK]
+            query = _odata_query({"$select": "Товар_Key,КоличествоBalance"})
+            response = await self.client.get(f"{self._balance_url(warehouse, chunk)}?{query}")
+            response.raise_for_status()
+            page = _parse_entries(response.text)
+            found = {row.get('Товар_Key') for row in page}
+            page += [{"Товар_Key": ref_key, "КоличествоBalance": "0"} for ref_key in chunk if ref_key not in found]
+            items.extend(await self._balance_items(page, warehouse))
+        return items
     
     async def get_product_info(self, product_code: str) -> Dict:
         return {}
     
     async def close(self):
-        await self.client.aclose()
+        if self._owns_client:
+            await self.client.aclose()
+
+
+async def refresh_nomenclature_index() -> int:
+    """Перезагрузить индекс номенклатуры из 1С"""
+    onec = OneCClient()
+    try:
+        entries = await onec.load_nomenclature()
+        nomenclature_index.replace(entries)
+        logger.info(f"Nomenclature index loaded: {len(entries)} items")
+        return len(entries)
+    finally:
+        await onec.close()
+
+
+async def backfill_counterparty_index() -> int:
+    """Заполнить индекс контрагентов по телефону из справочника 1С
+
+    Выполняется одним процессом на все экземпляры. Прерванная выгрузка
+    не отмечается завершённой и повторяется при следующем запуске
+    (уже сохранённые телефоны не перезаписываются).
+    """
+    async with advisory_lock(LOCK_COUNTERPARTY_BACKFILL) as acquired:
+        if not acquired:
+            logger.info("Counterparty index backfill is already running in another instance, skipping")
+            return 0
+        onec = OneCClient()
+        total = 0
+        try:
+            async for phones in onec.iter_kontragent_phones():
+                total += await counterparty_index.remember_counterparties(phones)
+            await counterparty_index.mark_backfilled()
+            logger.info(f"Counterparty index backfilled: {total} phones")
+            return total
+        finally:
+            await onec.close()
@@ -0,0 +1,78 @@
+"""Кэш ИИ-отчётов в PostgreSQL"""
+import hashlib
+import re
+from datetime import datetime, timedelta
+from typing import Optional
+from loguru import logger
+from sqlalchemy import select, update, delete
+from sqlalchemy.dialects.postgresql import insert
+from config import settings
+from database import async_session_maker, AIReportCache
+
+
+def normalize_query(query: str) -> str:
+    """Привести запрос к каноническому виду: регистр, ё, пробелы и знаки в конце"""
+    text = (query or "").lower().replace("ё", "е")
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip("?!.,;: ")
+
+
+def cache_key(query: str, model: str, date_from: datetime, date_to: datetime) -> str:
+    """Ключ кэша: нормализованный запрос, модель и дни периода данных"""
+    raw = "|".join([normalize_query(query), model, date_from.strftime("%Y-%m-%d"), date_to.strftime("%Y-%m-%d")])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+async def get_cached_report(key: str) -> Optional[str]:
+    """Неустаревший отчёт по ключу или None (ошибка БД не мешает построить отчёт заново)"""
+    now = datetime.utcnow()
+    try:
+        async with async_session_maker() as session:
+            result = await session.execute(
+                update(AIReportCache)
+                .where(AIReportCache.cache_key == key, AIReportCache.expires_at > now)
+                .values(hits=AIReportCache.hits + 1, last_used_at=now)
+                .returning(AIReportCache.report)
+            )
+            report = result.scalar_one_or_none()
+            await session.commit()
+            return report
+    except Exception as e:
+        logger.warning(f"AI report cache lookup failed: {e}")
+        return None
+
+
+async def store_report(key: str, query: str, model: str, date_from: datetime, date_to: datetime, report: str):
+    """Сохранить отчёт и вытеснить устаревшие и давно не использованные записи"""
+    now = datetime.utcnow()
+    values = {
+        "query": normalize_query(query),
+        "model": model,
+        "date_from": date_from,
+        "date_to": date_to,
+        "report": report,
+        "hits": 0,
+        "created_at": now,
+        "expires_at": now + timedelta(seconds=settings.ai_report_cache_ttl),
+        "last_used_at": now
+    }
+    try:
+        async with async_session_maker() as session:
+            stmt = insert(AIReportCache).values(cache_key=key, **values)
+            stmt = stmt.on_conflict_do_update(index_elements=[AIReportCache.cache_key], set_=values)
+            await session.execute(stmt)
+            
+            await session.execute(delete(AIReportCache).where(AIReportCache.expires_at <= now))
+            overflow = (
+                select(AIReportCache.cache_key)
+                .order_by(AIReportCache.last_used_at.desc())
+                .offset(settings.ai_report_cache_max_size)
+            )
+            evicted = await session.execute(delete(AIReportCache).where(AIReportCache.cache_key.in_(overflow)))
+            await session.commit()
+    except Exception as e:
+        logger.warning(f"Failed to store AI report in cache: {e}")
+        return
+    
+    if evicted.rowcount:
+        logger.info(f"AI report cache evicted {evicted.rowcount} entries")
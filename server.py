@@ -1,33 +1,45 @@
 """Основной FastAPI сервер"""
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Request
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Request, Query, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import Dict, Optional
+from datetime import datetime, timezone
 from loguru import logger
 from contextlib import asynccontextmanager
-import sys
 import json
+import asyncio
 
 from config import settings
-from database import init_db, get_session, SyncLog, ProductMapping
+from logging_setup import setup_logging, sampled_logger
+from database import init_db, get_session, async_session_maker, ProductMapping, ProcessedDeal, SyncLog
 from bitrix24_client import Bitrix24Client
-from onec_client import OneCClient
+from onec_client import OneCClient, refresh_nomenclature_index, backfill_counterparty_index
+from nomenclature_index import nomenclature_index
 from ai_reports import AIReportsService
-from sync_service import SyncService
+from sync_service import SyncService, invalidate_pushed_stock
 from telegram_bot import TelegramBot
+from http_clients import http_clients
+import counterparty_index
+from mapping_index import mapping_index
+from job_queue import enqueue_deal_job, deal_job_workers
+from sync_log_writer import sync_log_writer
+from metrics import collect_queue_depth, metrics_registry, mark_process_dead
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from mapping_import import MAPPING_FIELDS, CSV_HEADER, iter_lines, iter_json_array, parse_csv_line, validate_row, upsert_mappings
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update, delete, exists, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 
 # Настройка логирования
-logger.remove()
-logger.add(sys.stderr, level=settings.log_level)
-logger.add("logs/app.log", rotation="1 day", retention="30 days", level=settings.log_level)
+setup_logging()
 
 
 # Модели данных
 class AIReportRequest(BaseModel):
     """Запрос на генерацию ИИ-отчёта"""
     query: str
+    stream: bool = False
 
 
 class ProductMappingCreate(BaseModel):
@@ -44,11 +56,31 @@ async def lifespan(app: FastAPI):
     """Инициализация и завершение приложения"""
     logger.info("Starting application...")
     
+    await http_clients.start()
+    
     await init_db()
     logger.info("Database initialized")
     
+    sync_log_writer.start()
+    
+    await mapping_index.load()
+    mapping_index.start_listener()
+    
+    nomenclature_index.start_background_refresh(
+        refresh_nomenclature_index,
+        settings.nomenclature_refresh_interval
+    )
+    
+    # Заполнение индекса контрагентов по телефону, пока оно ни разу не завершилось
+    backfill_task = None
+    if not await counterparty_index.is_backfilled():
+        backfill_task = asyncio.create_task(backfill_counterparty_index())
+    
+    deal_job_workers.start(process_deal_to_1c, settings.deal_workers)
+    
     sync_service = SyncService()
     await sync_service.start_scheduler()
+    app.state.sync_service = sync_service
     logger.info("Sync scheduler started")
     
     # Отправка уведомления о запуске
@@ -60,7 +92,16 @@ async def lifespan(app: FastAPI):
     yield
     
     logger.info("Shutting down application...")
+    await deal_job_workers.stop()
     await sync_service.stop_scheduler()
+    await nomenclature_index.stop_background_refresh()
+    await mapping_index.stop_listener()
+    if backfill_task and not backfill_task.done():
+        backfill_task.cancel()
+    await sync_log_writer.stop()
+    await http_clients.close()
+    mark_process_dead()
+    await logger.complete()
 
 
 # Создание приложения
@@ -82,10 +123,19 @@ async def root():
     }
 
 
+@app.get("/metrics")
+async def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    try:
+        await collect_queue_depth()
+    except Exception as e:
+        logger.warning(f"Failed to collect deal job queue depth: {e}")
+    return Response(content=generate_latest(metrics_registry()), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
 @app.post("/webhook/bitrix24/deal")
 async def bitrix24_deal_webhook(
     request: Request,
-    background_tasks: BackgroundTasks,
     session: AsyncSession = Depends(get_session)
 ):
     """Webhook для обработки событий сделок из Bitrix24"""
@@ -94,9 +144,10 @@ async def bitrix24_deal_webhook(
         form_data = await request.form()
         data = dict(form_data)
         
-        logger.info(f"Received webhook data: {data}")
-        
         event = data.get("event")
+        logger.info(f"Received webhook {event} for deal {data.get('data[FIELDS][ID]')}")
+        sampled_logger.opt(lazy=True).debug("Webhook payload: {}", lambda: data)
+        
         if not event or event not in ["ONCRMDEALADD", "ONCRMDEALUPDATE"]:
             return {"status": "ignored", "message": f"Not a deal event: {event}"}
         
@@ -106,8 +157,8 @@ async def bitrix24_deal_webhook(
             logger.error(f"Deal ID not found in data: {data}")
             raise HTTPException(status_code=400, detail="Deal ID not found")
         
-        logger.info(f"Processing deal {deal_id} from event {event}")
-        background_tasks.add_task(process_deal_to_1c, deal_id, session)
+        job_id = await enqueue_deal_job(session, deal_id, event)
+        logger.info(f"Deal {deal_id} from event {event} queued as job {job_id}")
         
         return {
             "status": "accepted",
@@ -119,8 +170,54 @@ async def bitrix24_deal_webhook(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def _write_back_order(bitrix24: Bitrix24Client, session: AsyncSession, deal_id: str, content_hash: str, order_number: str):
+    """Записать номер документа 1С в сделку Bitrix24 и отметить это в ProcessedDeal
+    
+    Методы клиента не бросают исключений, а возвращают False: при ошибке
+    bitrix24_synced_at не заполняется, и задача повторит запись.
+    """
+    if not await bitrix24.update_deal_field(deal_id, "UF_1C_ORDER_ID", order_number):
+        raise RuntimeError(f"Failed to write 1C document {order_number} to deal {deal_id}")
+    if not await bitrix24.create_activity(
+        deal_id,
+        "Накладная создана в 1С",
+        f"Номер накладной: {order_number}"
+    ):
+        raise RuntimeError(f"Failed to add 1C document {order_number} activity to deal {deal_id}")
+    await session.execute(
+        update(ProcessedDeal)
+        .where(ProcessedDeal.deal_id == deal_id, ProcessedDeal.content_hash == content_hash)
+        .values(bitrix24_synced_at=datetime.utcnow())
+    )
+    await session.commit()
+
+
+async def _resolve_unconfirmed_order(onec: OneCClient, session: AsyncSession, deal_id: str):
+    """Найти в 1С документ, ответ на создание которого не был получен
+    
+    Если прошлый POST завершился таймаутом или 5xx, документ мог быть создан.
+    Найденный номер записывается в ProcessedDeal; если документа нет,
+    отметки удаляются и сделка обрабатывается заново.
+    """
+    unconfirmed = await session.scalar(
+        select(exists().where(ProcessedDeal.deal_id == deal_id, ProcessedDeal.order_number.is_(None)))
+    )
+    if not unconfirmed:
+        return
+    
+    order = await onec.find_order(deal_id)
+    stmt = update(ProcessedDeal).where(ProcessedDeal.deal_id == deal_id, ProcessedDeal.order_number.is_(None))
+    if order and order["order_number"]:
+        logger.warning(f"Found 1C document {order['order_number']} for deal {deal_id} created by an unconfirmed request")
+        await session.execute(stmt.values(order_number=order["order_number"]))
+    else:
+        logger.info(f"No 1C document found for deal {deal_id} after an unconfirmed request, creating it again")
+        await session.execute(delete(ProcessedDeal).where(ProcessedDeal.deal_id == deal_id, ProcessedDeal.order_number.is_(None)))
+    await session.commit()
+
+
 async def process_deal_to_1c(deal_id: str, session: AsyncSession):
-    """Обработка сделки и отправка в 1С"""
+    """Обработка сделки и отправка в 1С (вызывается воркером очереди со своей сессией)"""
     bitrix24 = Bitrix24Client()
     onec = OneCClient()
     telegram = None
@@ -131,34 +228,68 @@ async def process_deal_to_1c(deal_id: str, session: AsyncSession):
     try:
         logger.info(f"Processing deal {deal_id} for 1C")
         
-        deal = await bitrix24.get_deal(deal_id)
-        logger.info(f"Deal data: {deal}")
+        details = await bitrix24.get_deal_details(deal_id)
+        deal = details.deal
+        sampled_logger.opt(lazy=True).debug("Deal {} data: {}", lambda: deal_id, lambda: deal)
         
-        is_kaspi = deal.get("UF_KASPI_PAYMENT") == "1" or "kaspi" in deal.get("TITLE", "").lower()
-        
-        if not is_kaspi:
+        if not details.is_kaspi:
             logger.info(f"Deal {deal_id} is not a Kaspi payment, skipping")
             return
         
-        products = await bitrix24.get_deal_products(deal_id)
-        contact_id = deal.get("CONTACT_ID")
-        contact = await bitrix24.get_contact(contact_id) if contact_id else {}
+        content_hash = details.content_hash
+        await _resolve_unconfirmed_order(onec, session, deal_id)
+        processed = await session.get(ProcessedDeal, (deal_id, content_hash))
+        if processed and processed.order_number:
+            if processed.bitrix24_synced_at is None:
+                # Документ создан, но запись в Bitrix24 в прошлый раз не удалась
+                logger.info(f"Deal {deal_id} already has 1C document {processed.order_number}, retrying Bitrix24 write-back")
+                await _write_back_order(bitrix24, session, deal_id, content_hash, processed.order_number)
+            else:
+                logger.info(f"Deal {deal_id} already has 1C document {processed.order_number} for the same content, skipping")
+            return
+        
+        # Документ по сделке уже создан, но товары или сумма с тех пор изменились:
+        # второй документ не создаётся, расхождение исправляется в 1С вручную
+        previous = await session.scalar(
+            select(ProcessedDeal)
+            .where(ProcessedDeal.deal_id == deal_id, ProcessedDeal.order_number.is_not(None))
+            .order_by(ProcessedDeal.created_at.desc())
+            .limit(1)
+        )
+        if previous:
+            logger.warning(f"Deal {deal_id} changed after 1C document {previous.order_number} was created, not creating another one")
+            if telegram:
+                await telegram.notify_error(
+                    f"Сделка {deal_id} изменена после создания накладной {previous.order_number} в 1С. "
+                    f"Новая накладная не создана, проверьте документ вручную"
+                )
+            # Повторные события с тем же составом не дают повторных уведомлений
+            await session.execute(
+                pg_insert(ProcessedDeal)
+                .values(
+                    deal_id=deal_id,
+                    content_hash=content_hash,
+                    order_number=previous.order_number,
+                    bitrix24_synced_at=datetime.utcnow()
+                )
+                .on_conflict_do_nothing()
+            )
+            await session.commit()
+            return
         
-        customer_name = contact.get("NAME", "") + " " + contact.get("LAST_NAME", "")
-        customer_phone = contact.get("PHONE", [{}])[0].get("VALUE", "") if contact.get("PHONE") else ""
+        products = details.products
+        customer_name = details.customer_name
+        customer_phone = details.customer_phone
         
+        await mapping_index.ensure_loaded()
         mapped_products = []
         for product in products:
-            stmt = select(ProductMapping).where(
-                ProductMapping.bitrix24_product_id == str(product.get("PRODUCT_ID"))
-            )
-            result = await session.execute(stmt)
-            mapping = result.scalar_one_or_none()
+            mapping = mapping_index.by_bitrix24(str(product.get("PRODUCT_ID")))
             
             if mapping:
                 mapped_products.append({
-                    "code": mapping.onec_product_code,
-                    "name": mapping.onec_product_name,
+                    "code": mapping["onec_product_code"],
+                    "name": mapping["onec_product_name"],
                     "quantity": int(product.get("QUANTITY", 1)),
                     "price": float(product.get("PRICE", 0))
                 })
@@ -184,12 +315,13 @@ async def process_deal_to_1c(deal_id: str, session: AsyncSession):
         
         if result.get("success"):
             order_number = result.get("order_number")
-            await bitrix24.update_deal_field(deal_id, "UF_1C_ORDER_ID", order_number)
-            await bitrix24.create_activity(
-                deal_id,
-                "Накладная создана в 1С",
-                f"Номер накладной: {order_number}"
-            )
+            # Фиксируем сразу, чтобы повторная обработка не создала дубль документа
+            stmt = pg_insert(ProcessedDeal).values(deal_id=deal_id, content_hash=content_hash, order_number=order_number)
+            await session.execute(stmt.on_conflict_do_update(
+                index_elements=[ProcessedDeal.deal_id, ProcessedDeal.content_hash],
+                set_={"order_number": stmt.excluded.order_number}
+            ))
+            await session.commit()
             
             # Telegram уведомление
             if telegram:
@@ -199,27 +331,35 @@ async def process_deal_to_1c(deal_id: str, session: AsyncSession):
                     customer_name.strip() or "Клиент Kaspi"
                 )
             
-            log_entry = SyncLog(
+            sync_log_writer.add(
                 sync_type="order_to_1c",
                 direction="bitrix24_to_1c",
                 status="success",
                 entity_id=deal_id,
-                request_data=json.dumps(order_data),
-                response_data=json.dumps(result)
+                request_data=order_data,
+                response_data=result
             )
-            session.add(log_entry)
-            await session.commit()
             
             logger.info(f"Order {order_number} created in 1C for deal {deal_id}")
+            
+            # При ошибке задача повторится и по ProcessedDeal выполнит только запись в Bitrix24
+            await _write_back_order(bitrix24, session, deal_id, content_hash, order_number)
         else:
-            error_msg = result.get("error", "Unknown error")
-            if telegram:
-                await telegram.notify_error(f"Ошибка создания накладной для сделки {deal_id}: {error_msg}")
+            if result.get("ambiguous"):
+                # Документ мог быть создан: повтор сначала ищет его в 1С, а не создаёт заново
+                await session.execute(
+                    pg_insert(ProcessedDeal)
+                    .values(deal_id=deal_id, content_hash=content_hash, order_number=None)
+                    .on_conflict_do_nothing()
+                )
+                await session.commit()
+            # Повтор и уведомление об окончательной ошибке выполняет очередь задач
+            raise RuntimeError(f"1C document for deal {deal_id} was not created: {result.get('message', 'Unknown error')}")
     
     except Exception as e:
+        # Повтор и уведомление об окончательной ошибке выполняет очередь задач
         logger.error(f"Error processing deal {deal_id}: {e}", exc_info=True)
-        if telegram:
-            await telegram.notify_error(f"Ошибка обработки сделки {deal_id}: {str(e)}")
+        raise
     
     finally:
         await bitrix24.close()
@@ -228,9 +368,60 @@ async def process_deal_to_1c(deal_id: str, session: AsyncSession):
             await telegram.close()
 
 
+def _sse(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# Интервал комментариев-keepalive, пока отчёт ещё не начал поступать, с
+SSE_KEEPALIVE_INTERVAL = 5.0
+
+
+async def _stream_ai_report(query: str):
+    """Отчёт в формате Server-Sent Events: progress, события chunk, затем done или error
+    
+    Событие progress уходит сразу, до выгрузки сделок из Bitrix24; пока
+    данные собираются, соединение поддерживается SSE-комментариями.
+    """
+    ai_service = AIReportsService()
+    chunks = ai_service.stream_report(query).__aiter__()
+    next_chunk = None
+    try:
+        yield _sse("progress", {"stage": "collecting_data"})
+        while True:
+            if next_chunk is None:
+                next_chunk = asyncio.ensure_future(chunks.__anext__())
+            done, _ = await asyncio.wait({next_chunk}, timeout=SSE_KEEPALIVE_INTERVAL)
+            if not done:
+                yield ": keepalive\n\n"
+                continue
+            task, next_chunk = next_chunk, None
+            try:
+                content = task.result()
+            except StopAsyncIteration:
+                break
+            yield _sse("chunk", {"text": content})
+        yield _sse("done", {})
+    except Exception as e:
+        logger.error(f"Error streaming AI report: {e}")
+        yield _sse("error", {"detail": str(e)})
+    finally:
+        if next_chunk is not None:
+            next_chunk.cancel()
+            await asyncio.gather(next_chunk, return_exceptions=True)
+        await chunks.aclose()
+        await ai_service.close()
+
+
 @app.post("/api/ai-report")
 async def generate_ai_report(request: AIReportRequest):
-    """Генерация аналитического отчёта через ИИ"""
+    """Генерация аналитического отчёта через ИИ (stream=true — поток Server-Sent Events)"""
+    if request.stream:
+        return StreamingResponse(
+            _stream_ai_report(request.query),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    
     ai_service = AIReportsService()
     
     try:
@@ -247,10 +438,18 @@ async def generate_ai_report(request: AIReportRequest):
 
 
 @app.post("/api/sync/stock")
-async def trigger_stock_sync(background_tasks: BackgroundTasks):
-    """Ручной запуск синхронизации остатков"""
-    sync_service = SyncService()
-    background_tasks.add_task(sync_service.sync_stock_to_bitrix24)
+async def trigger_stock_sync(request: Request, background_tasks: BackgroundTasks, full: bool = False):
+    """Ручной запуск синхронизации остатков (full=true — отправить все позиции)
+    
+    Если синхронизация уже идёт в каком-либо экземпляре, вторая не запускается.
+    """
+    sync_service = request.app.state.sync_service
+    if await sync_service.is_stock_sync_running():
+        return {
+            "status": "running",
+            "message": "Stock synchronization is already running"
+        }
+    background_tasks.add_task(sync_service.run_stock_sync, False if full else None)
     
     return {
         "status": "started",
@@ -258,6 +457,98 @@ async def trigger_stock_sync(background_tasks: BackgroundTasks):
     }
 
 
+@app.post("/api/sync/counterparties")
+async def trigger_counterparty_backfill(background_tasks: BackgroundTasks):
+    """Ручное заполнение индекса контрагентов по телефону из 1С"""
+    background_tasks.add_task(backfill_counterparty_index)
+    
+    return {
+        "status": "started",
+        "message": "Counterparty index backfill started"
+    }
+
+
+def _naive_utc(value: datetime) -> datetime:
+    """Время с часовым поясом -> UTC без пояса (created_at хранится как timestamp without time zone)"""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+SYNC_LOG_COLUMNS = (
+    SyncLog.id,
+    SyncLog.sync_type,
+    SyncLog.direction,
+    SyncLog.status,
+    SyncLog.entity_id,
+    SyncLog.error_message,
+    SyncLog.created_at
+)
+
+
+@app.get("/api/sync/logs")
+async def get_sync_logs(
+    limit: int = Query(100, ge=1, le=1000),
+    before: Optional[str] = None,
+    sync_type: Optional[str] = None,
+    status: Optional[str] = None,
+    entity_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    include_data: bool = False,
+    session: AsyncSession = Depends(get_session)
+):
+    """Журнал синхронизаций, новые записи первыми
+    
+    Постраничная выдача по (created_at, id): следующая страница —
+    before=next_before. since/until ограничивают период, что позволяет
+    читать только нужные месячные секции. include_data=true добавляет
+    request_data/response_data.
+    """
+    columns = SYNC_LOG_COLUMNS + ((SyncLog.request_data, SyncLog.response_data) if include_data else ())
+    stmt = select(*columns).order_by(SyncLog.created_at.desc(), SyncLog.id.desc()).limit(limit)
+    if before is not None:
+        try:
+            created_at, _, log_id = before.rpartition("_")
+            cursor = (_naive_utc(datetime.fromisoformat(created_at)), int(log_id))
+        except ValueError:
+            raise HTTPException(status_code=422, detail="before must be <created_at>_<id> from next_before")
+        stmt = stmt.where(tuple_(SyncLog.created_at, SyncLog.id) < cursor)
+    if sync_type is not None:
+        stmt = stmt.where(SyncLog.sync_type == sync_type)
+    if status is not None:
+        stmt = stmt.where(SyncLog.status == status)
+    if entity_id is not None:
+        stmt = stmt.where(SyncLog.entity_id == entity_id)
+    if since is not None:
+        stmt = stmt.where(SyncLog.created_at >= _naive_utc(since))
+    if until is not None:
+        stmt = stmt.where(SyncLog.created_at < _naive_utc(until))
+    
+    result = await session.execute(stmt)
+    logs = [dict(row._mapping) for row in result]
+    
+    next_before = None
+    if len(logs) == limit:
+        next_before = f"{logs[-1]['created_at'].isoformat()}_{logs[-1]['id']}"
+    for log in logs:
+        log["created_at"] = log["created_at"].isoformat()
+    return {"logs": logs, "next_before": next_before}
+
+
+@app.post("/api/cache/nomenclature/invalidate")
+async def invalidate_nomenclature_cache(background_tasks: BackgroundTasks, code: Optional[str] = None):
+    """Сбросить кэш номенклатуры 1С (целиком или по коду)"""
+    nomenclature_index.invalidate(code)
+    if code is None:
+        background_tasks.add_task(refresh_nomenclature_index)
+    
+    return {
+        "status": "success",
+        "message": f"Nomenclature cache invalidated{f' for {code}' if code else ''}"
+    }
+
+
 @app.post("/api/mapping/product")
 async def create_product_mapping(
     mapping: ProductMappingCreate,
@@ -273,7 +564,10 @@ async def create_product_mapping(
         )
         
         session.add(new_mapping)
+        await invalidate_pushed_stock(session, [mapping.onec_product_code])
+        await mapping_index.notify_changed(session)
         await session.commit()
+        mapping_index.put(mapping.model_dump())
         
         logger.info(f"Created product mapping: {mapping.bitrix24_product_id} -> {mapping.onec_product_code}")
         
@@ -288,25 +582,185 @@ async def create_product_mapping(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/api/mapping/products/bulk")
+async def bulk_import_product_mappings(request: Request, session: AsyncSession = Depends(get_session)):
+    """Массовая загрузка маппинга товаров с upsert
+    
+    Принимает файл в формате mapping.csv (multipart, поле file), CSV в теле
+    запроса (text/csv), NDJSON (application/x-ndjson) или JSON-массив объектов
+    с полями ProductMappingCreate. Все форматы разбираются потоком и
+    записываются пачками; при ошибке посередине уже записанные пачки
+    остаются и рассылаются другим процессам.
+    """
+    content_type = request.headers.get("content-type", "")
+    stats = {"created": 0, "updated": 0, "rejected": 0, "errors": []}
+    pending: Dict[str, Dict] = {}
+    
+    def reject(line_no: int, reason: str):
+        stats["rejected"] += 1
+        if len(stats["errors"]) < 100:
+            stats["errors"].append({"line": line_no, "error": reason})
+    
+    async def flush():
+        if not pending:
+            return
+        rows = [row for _, row in pending.values()]
+        created, updated = await upsert_mappings(session, rows)
+        await invalidate_pushed_stock(session, [row["onec_product_code"] for row in rows])
+        await session.commit()
+        stats["created"] += created
+        stats["updated"] += updated
+        pending.clear()
+    
+    async def add(line_no: int, values: Dict):
+        row, error = validate_row(values)
+        if error:
+            reject(line_no, error)
+            return
+        previous = pending.pop(row["bitrix24_product_id"], None)
+        if previous:
+            reject(previous[0], f"Duplicate bitrix24_product_id, superseded by line {line_no}")
+        pending[row["bitrix24_product_id"]] = (line_no, row)
+        if len(pending) >= settings.mapping_import_chunk_size:
+            await flush()
+    
+    try:
+        if content_type.startswith("application/json"):
+            line_no = 0
+            try:
+                async for item in iter_json_array(request.stream()):
+                    line_no += 1
+                    if isinstance(item, dict):
+                        await add(line_no, item)
+                    else:
+                        reject(line_no, "Expected an object")
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid JSON array: {e}")
+        
+        elif content_type.startswith("application/x-ndjson"):
+            line_no = 0
+            async for line in iter_lines(request.stream()):
+                line_no += 1
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError as e:
+                    reject(line_no, f"Invalid JSON: {e}")
+                    continue
+                await add(line_no, item if isinstance(item, dict) else {})
+        
+        else:
+            if content_type.startswith("multipart/form-data"):
+                form = await request.form()
+                upload = form.get("file")
+                if upload is None or isinstance(upload, str):
+                    raise HTTPException(status_code=400, detail="CSV file is expected in field 'file'")
+                
+                async def _read_upload():
+                    while data := await upload.read(64 * 1024):
+                        yield data
+                
+                chunks = _read_upload()
+            else:
+                chunks = request.stream()
+            
+            line_no = 0
+            async for line in iter_lines(chunks):
+                line_no += 1
+                values = parse_csv_line(line)
+                if values is None:
+                    continue
+                if line_no == 1 and tuple(values) in (CSV_HEADER, MAPPING_FIELDS):
+                    continue
+                if len(values) != len(MAPPING_FIELDS):
+                    reject(line_no, f"Expected {len(MAPPING_FIELDS)} columns, got {len(values)}")
+                    continue
+                await add(line_no, dict(zip(MAPPING_FIELDS, values)))
+        
+        await flush()
+        
+        logger.info(f"Bulk mapping import: created {stats['created']}, updated {stats['updated']}, rejected {stats['rejected']}")
+        return {"status": "success", **stats}
+    
+    except HTTPException:
+        await session.rollback()
+        raise
+    except Exception as e:
+        logger.error(f"Error importing product mappings: {e}")
+        await session.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    finally:
+        # Пачки фиксируются по отдельности: индексы обновляются и после ошибки
+        if stats["created"] or stats["updated"]:
+            try:
+                await mapping_index.notify_changed(session)
+                await session.commit()
+                await mapping_index.load()
+            except Exception as e:
+                logger.error(f"Failed to publish imported product mappings: {e}")
+
+
+MAPPING_COLUMNS = (
+    ProductMapping.id,
+    ProductMapping.bitrix24_product_id,
+    ProductMapping.bitrix24_product_name,
+    ProductMapping.onec_product_code,
+    ProductMapping.onec_product_name
+)
+
+
 @app.get("/api/mapping/products")
-async def get_product_mappings(session: AsyncSession = Depends(get_session)):
-    """Получить все маппинги товаров"""
-    stmt = select(ProductMapping)
+async def get_product_mappings(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=10000),
+    after_id: Optional[int] = None,
+    bitrix24_product_id: Optional[str] = None,
+    onec_product_code: Optional[str] = None,
+    output_format: str = Query("json", alias="format", pattern="^(json|ndjson)$"),
+    session: AsyncSession = Depends(get_session)
+):
+    """Получить маппинги товаров
+    
+    Без параметров возвращает все маппинги. limit/after_id — постраничная
+    выдача по id (следующая страница: after_id=next_after_id), format=ndjson —
+    потоковая выдача построчно. ETag — версия маппинга, которая растёт вместе
+    с notify_changed; при совпадении If-None-Match возвращается 304 без
+    обращения к таблице маппинга.
+    """
+    etag = f'W/"{await mapping_index.version(session)}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    
+    stmt = select(*MAPPING_COLUMNS).order_by(ProductMapping.id)
+    if after_id is not None:
+        stmt = stmt.where(ProductMapping.id > after_id)
+    if bitrix24_product_id is not None:
+        stmt = stmt.where(ProductMapping.bitrix24_product_id == bitrix24_product_id)
+    if onec_product_code is not None:
+        stmt = stmt.where(ProductMapping.onec_product_code == onec_product_code)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    
+    if output_format == "ndjson":
+        async def _stream():
+            # Сессия зависимости закрывается до отправки ответа, поэтому курсор открывается в своей
+            async with async_session_maker() as stream_session:
+                result = await stream_session.stream(stmt.execution_options(yield_per=1000))
+                async for row in result:
+                    yield json.dumps(dict(row._mapping), ensure_ascii=False) + "\n"
+        
+        return StreamingResponse(_stream(), media_type="application/x-ndjson", headers=headers)
+    
     result = await session.execute(stmt)
-    mappings = result.scalars().all()
+    mappings = [dict(row._mapping) for row in result]
     
-    return {
-        "mappings": [
-            {
-                "id": m.id,
-                "bitrix24_product_id": m.bitrix24_product_id,
-                "bitrix24_product_name": m.bitrix24_product_name,
-                "onec_product_code": m.onec_product_code,
-                "onec_product_name": m.onec_product_name
-            }
-            for m in mappings
-        ]
-    }
+    body = {"mappings": mappings}
+    if limit is not None:
+        body["next_after_id"] = mappings[-1]["id"] if len(mappings) == limit else None
+    return JSONResponse(body, headers=headers)
 
 
 @app.post("/webhook/telegram")
@@ -325,7 +779,7 @@ async def telegram_webhook(request: Request):
         if '📦' in text:
             await tg.send_message("⏳ Загружаю остатки...")
             from stock_report import get_stock_report
-            report = await get_stock_report(settings.onec_base_url, settings.onec_username, settings.onec_password)
+            report = await get_stock_report()
             await tg.send_message(report)
         elif '📊' in text:
             status = "📊 *СТАТУС СИСТЕМЫ*\n\n✅ Middleware: Работает\n✅ 1С OData: Подключено\n✅ Bitrix24: Активно\n✅ PostgreSQL: OK"
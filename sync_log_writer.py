@@ -0,0 +1,186 @@
+"""Буферизованная запись журнала синхронизаций"""
+import asyncio
+import json
+import os
+from datetime import datetime
+from typing import Dict, List, Optional
+from loguru import logger
+from sqlalchemy import insert
+from config import settings
+from database import async_session_maker, SyncLog
+
+
+class SyncLogWriter:
+    """Копит записи SyncLog в памяти и пишет их пачками одним INSERT
+
+    Сброс — по размеру буфера, по таймеру и при остановке приложения.
+    Если БД недоступна, пачка дописывается в локальный файл (JSON по строке
+    на запись) и загружается в БД при следующем успешном сбросе.
+    """
+    
+    def __init__(self, batch_size: int, flush_interval: float, spill_path: str):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self._buffer: List[Dict] = []
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+    
+    def add(self, **fields):
+        """Поставить запись в очередь (без обращения к БД)"""
+        fields.setdefault("created_at", datetime.utcnow())
+        self._buffer.append(fields)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+    
+    def _spill(self, rows: List[Dict]):
+        os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+        with open(self.spill_path, "a", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps({**row, "created_at": row["created_at"].isoformat()}, ensure_ascii=False) + "\n")
+    
+    @staticmethod
+    def _read_replay(path: str) -> List[Dict]:
+        """Прочитать взятый файл и удалить его"""
+        rows = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                    row["created_at"] = datetime.fromisoformat(row["created_at"])
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning(f"Skipping malformed spilled sync log entry: {e}")
+                    continue
+                rows.append(row)
+        os.remove(path)
+        return rows
+    
+    @staticmethod
+    def _is_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+    
+    def _orphaned_replays(self) -> List[str]:
+        """Файлы .replay завершившихся процессов (упали между взятием и удалением файла)"""
+        directory = os.path.dirname(self.spill_path) or "."
+        prefix = os.path.basename(self.spill_path) + "."
+        orphaned = []
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        for name in names:
+            if not (name.startswith(prefix) and name.endswith(".replay")):
+                continue
+            pid = name[len(prefix):-len(".replay")]
+            if pid.isdigit() and int(pid) != os.getpid() and not self._is_alive(int(pid)):
+                orphaned.append(os.path.join(directory, name))
+        return orphaned
+    
+    def _take_spilled(self) -> List[Dict]:
+        """Забрать записи из файла (файл переименовывается, чтобы не прочитать его дважды)"""
+        taken = f"{self.spill_path}.{os.getpid()}.replay"
+        rows = []
+        try:
+            # Файл, оставшийся от неудачного чтения, дочитывается в первую очередь
+            if os.path.exists(taken):
+                rows.extend(self._read_replay(taken))
+            # Файлы упавших процессов (их PID уже не вернётся): переименование
+            # забирает каждый файл только одному воркеру
+            for orphan in self._orphaned_replays():
+                try:
+                    os.replace(orphan, taken)
+                except FileNotFoundError:
+                    continue
+                logger.warning(f"Replaying sync log entries left by a terminated process in {orphan}")
+                rows.extend(self._read_replay(taken))
+            try:
+                os.replace(self.spill_path, taken)
+            except FileNotFoundError:
+                # Файла нет или его уже забрал другой воркер
+                return rows
+            rows.extend(self._read_replay(taken))
+        except OSError:
+            # Уже прочитанные файлы удалены: их записи нельзя потерять из-за следующего
+            if not rows:
+                raise
+            logger.exception(f"Failed to read spilled sync log entries, {len(rows)} were restored")
+        return rows
+    
+    async def _insert(self, rows: List[Dict]):
+        async with async_session_maker() as session:
+            for start in range(0, len(rows), self.batch_size):
+                await session.execute(insert(SyncLog), rows[start:start + self.batch_size])
+            await session.commit()
+    
+    async def flush(self):
+        """Записать накопленное в БД, при ошибке — в файл"""
+        async with self._flush_lock:
+            rows, self._buffer = self._buffer, []
+            try:
+                spilled = await asyncio.to_thread(self._take_spilled)
+            except Exception:
+                logger.exception(f"Failed to read spilled sync log entries from {self.spill_path}")
+                spilled = []
+            rows = spilled + rows
+            if not rows:
+                return
+            try:
+                await self._insert(rows)
+                if spilled:
+                    logger.info(f"Restored {len(spilled)} sync log entries from {self.spill_path}")
+            except Exception as e:
+                logger.error(f"Failed to write {len(rows)} sync log entries, spilling to {self.spill_path}: {e}")
+                try:
+                    await asyncio.to_thread(self._spill, rows)
+                except Exception:
+                    # Записи остаются в памяти до следующего сброса
+                    logger.exception(f"Failed to spill {len(rows)} sync log entries, keeping them in memory")
+                    self._buffer = rows + self._buffer
+    
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                # Отмена при остановке не должна терять уже взятую из буфера пачку
+                await asyncio.shield(self.flush())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Sync log flush failed")
+    
+    def start(self):
+        """Запустить фоновый сброс"""
+        if self._task and not self._task.done():
+            return
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Остановить фоновый сброс и записать остаток буфера"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+sync_log_writer = SyncLogWriter(
+    batch_size=settings.sync_log_batch_size,
+    flush_interval=settings.sync_log_flush_interval,
+    spill_path=settings.sync_log_spill_path
+)
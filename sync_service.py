@@ -1,14 +1,38 @@
 """Сервис синхронизации остатков"""
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from loguru import logger
-from datetime import datetime
+import asyncio
 import json
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List, Optional, Set
+import time
 
 from config import settings
 from bitrix24_client import Bitrix24Client
 from onec_client import OneCClient
-from database import async_session_maker, SyncLog, StockSnapshot, ProductMapping
-from sqlalchemy import select
+from database import async_session_maker, maintain_partitions, StockSnapshot, StockLastPushed, SyncState
+from sync_log_writer import sync_log_writer
+from leader_election import leader_election, advisory_lock, is_locked, LOCK_STOCK_SYNC, LOCK_STOCK_PUSH
+from mapping_index import mapping_index
+from metrics import STOCK_SYNC_DURATION, STOCK_SYNC_ITEMS, STOCK_SYNC_LAST_SUCCESS
+from sqlalchemy import select, insert, delete
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+
+# Ключи SyncState: период последнего обработанного движения регистра остатков 1С
+# и Ref_Key товаров, которые не удалось отправить в Bitrix24 (повторяются следующим прогоном)
+STOCK_WATERMARK_KEY = "stock_movements_watermark"
+STOCK_RETRY_KEY = "stock_movements_retry"
+
+
+async def invalidate_pushed_stock(session, codes: List[str]):
+    """Забыть отправленные остатки товаров 1С, чтобы delta-прогон отправил их заново
+
+    Вызывается при изменении маппинга: новый товар Bitrix24 должен получить
+    остаток, даже если в 1С он не менялся. Фиксируется вместе с маппингом.
+    """
+    if codes:
+        await session.execute(delete(StockLastPushed).where(StockLastPushed.product_code.in_(list(set(codes)))))
 
 
 class SyncService:
@@ -18,102 +42,328 @@ class SyncService:
         self.scheduler = AsyncIOScheduler()
         self.bitrix24 = Bitrix24Client()
         self.onec = OneCClient()
+        self._sync_task: Optional[asyncio.Task] = None
     
     async def start_scheduler(self):
-        """Запуск планировщика синхронизации"""
+        """Запуск планировщика синхронизации
+        
+        Планировщик запускается приостановленным во всех процессах, задачи
+        выполняет только ведущий экземпляр (см. leader_election).
+        """
+        # При инкрементальной синхронизации ночной прогон — полная сверка всех
+        # сопоставленных позиций (распроданные отправляются с нулём)
         self.scheduler.add_job(
-            self.sync_stock_to_bitrix24,
+            self.run_stock_sync,
             'cron',
             hour=settings.sync_schedule_hour,
             minute=settings.sync_schedule_minute,
+            kwargs={"delta": False} if settings.stock_incremental_interval else None,
             id='sync_stock',
             replace_existing=True
         )
         
-        self.scheduler.start()
+        if settings.stock_incremental_interval:
+            self.scheduler.add_job(
+                self.sync_stock_incremental,
+                'interval',
+                seconds=settings.stock_incremental_interval,
+                id='sync_stock_incremental',
+                replace_existing=True,
+                max_instances=1,
+                coalesce=True
+            )
+        
+        self.scheduler.add_job(
+            maintain_partitions,
+            'interval',
+            hours=6,
+            id='maintain_partitions',
+            replace_existing=True
+        )
+        
+        self.scheduler.start(paused=True)
+        leader_election.start(on_elected=self.scheduler.resume, on_demoted=self.scheduler.pause)
         logger.info(f"Scheduler started. Stock sync scheduled at {settings.sync_schedule_hour:02d}:{settings.sync_schedule_minute:02d}")
     
     async def stop_scheduler(self):
         """Остановка планировщика"""
+        await leader_election.stop()
         self.scheduler.shutdown()
         await self.bitrix24.close()
         await self.onec.close()
         logger.info("Scheduler stopped")
     
-    async def sync_stock_to_bitrix24(self):
-        """Синхронизация остатков из 1С в Bitrix24"""
-        logger.info("Starting stock synchronization from 1C to Bitrix24")
+    async def _load_last_quantities(self, session, codes: List[str] = None) -> Dict[str, int]:
+        """Последний отправленный остаток по каждому товару (или только по codes)"""
+        stmt = select(StockLastPushed.product_code, StockLastPushed.quantity)
+        if codes is not None:
+            stmt = stmt.where(StockLastPushed.product_code.in_(codes))
+        result = await session.execute(stmt)
+        return {code: quantity for code, quantity in result.all()}
+    
+    async def _push_stock_chunk(self, session, items: List[Dict], stats: Dict, last_quantities: Optional[Dict[str, int]]):
+        """Отправить изменившиеся остатки пачки позиций в Bitrix24 и сохранить снимок"""
+        if last_quantities is not None:
+            changed = [item for item in items if last_quantities.get(item["product_code"]) != item["quantity"]]
+            stats["skipped"] += len(items) - len(changed)
+            items = changed
+        stats["changed"] += len(items)
+        if not items:
+            return
+        
+        quantities = {}
+        product_codes = {}
+        for item in items:
+            mappings = mapping_index.by_onec(item["product_code"])
+            if not mappings:
+                logger.warning(f"No mapping found for 1C product {item['product_code']}")
+            for mapping in mappings:
+                quantities[mapping["bitrix24_product_id"]] = item["quantity"]
+                product_codes[mapping["bitrix24_product_id"]] = item["product_code"]
+        
+        failed_codes = set()
+        if quantities:
+            batch_result = await self.bitrix24.update_product_quantities(quantities)
+            stats["updated"] += len(batch_result["updated"])
+            stats["failed_products"].update(batch_result["errors"])
+            failed_codes = {product_codes[product_id] for product_id in batch_result["errors"]}
+            stats["failed_refs"].update(item["ref_key"] for item in items if item["product_code"] in failed_codes and item.get("ref_key"))
+        
+        # В снимок попадают только отправленные позиции: неотправленные и ещё
+        # не сопоставленные с товаром Bitrix24 следующий delta-прогон повторит
+        pushed_codes = set(product_codes.values()) - failed_codes
+        rows = [
+            {
+                "product_code": item["product_code"],
+                "product_name": item["product_name"],
+                "quantity": item["quantity"],
+                "warehouse": item.get("warehouse", "Основной склад"),
+                "snapshot_date": stats["snapshot_date"]
+            }
+            for item in items
+            if item["product_code"] in pushed_codes
+        ]
+        if rows:
+            await session.execute(insert(StockSnapshot).values(rows))
+            last_pushed = pg_insert(StockLastPushed).values([
+                {"product_code": row["product_code"], "quantity": row["quantity"], "pushed_at": row["snapshot_date"]}
+                for row in {row["product_code"]: row for row in rows}.values()
+            ])
+            await session.execute(last_pushed.on_conflict_do_update(
+                index_elements=[StockLastPushed.product_code],
+                set_={"quantity": last_pushed.excluded.quantity, "pushed_at": last_pushed.excluded.pushed_at}
+            ))
+            await session.commit()
+    
+    async def is_stock_sync_running(self) -> bool:
+        """Идёт ли синхронизация остатков в этом или другом экземпляре"""
+        if self._sync_task and not self._sync_task.done():
+            return True
+        return await is_locked(LOCK_STOCK_SYNC)
+    
+    async def run_stock_sync(self, delta: bool = None):
+        """Запустить синхронизацию остатков или дождаться уже идущей в этом процессе"""
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.create_task(self.sync_stock_to_bitrix24(delta))
+        await asyncio.shield(self._sync_task)
+    
+    async def sync_stock_to_bitrix24(self, delta: bool = None):
+        """Синхронизация остатков из 1С в Bitrix24
+        
+        Остатки читаются из 1С потоком и отправляются в Bitrix24 пачками
+        по размеру batch, не дожидаясь загрузки всех страниц. В режиме delta
+        отправляются только позиции, изменившиеся с последней отправки.
+        Одновременно выполняется не больше одной синхронизации на все экземпляры;
+        идущий инкрементальный прогон она дожидается, а не пропускает ход.
+        """
+        async with advisory_lock(LOCK_STOCK_SYNC) as acquired:
+            if not acquired:
+                logger.info("Stock synchronization is already running in another instance, skipping")
+                return
+            async with advisory_lock(LOCK_STOCK_PUSH, wait=True):
+                if delta is None:
+                    delta = settings.stock_sync_delta
+                await self._sync_stock("delta" if delta else "full", self.onec.get_stock_balances(), delta)
+    
+    async def sync_stock_incremental(self):
+        """Инкрементальная синхронизация остатков по движениям регистра 1С
+        
+        Читает движения регистра ТоварыОрганизацийБУ с периодом после
+        сохранённого водяного знака (с запасом stock_incremental_overlap) и
+        отправляет остатки только затронутых товаров. Движения, удалённые
+        отменой проведения, и документы глубоко задним числом исправляет ночная
+        сверка: она отправляет остаток каждого сопоставленного товара, включая
+        нулевой для товаров, которых нет в Balance.
+        """
+        async with advisory_lock(LOCK_STOCK_PUSH) as acquired:
+            if not acquired:
+                logger.debug("Stock synchronization is already running, skipping incremental run")
+                return
+            
+            try:
+                watermark = await self._load_state(STOCK_WATERMARK_KEY)
+                if watermark is None:
+                    latest = await self.onec.get_latest_movement_period()
+                    if latest:
+                        await self._save_state({STOCK_WATERMARK_KEY: latest.isoformat()})
+                        logger.info(f"Stock movements watermark initialized at {latest.isoformat()}")
+                    return
+                watermark = datetime.fromisoformat(watermark)
+                retry = json.loads(await self._load_state(STOCK_RETRY_KEY) or "[]")
+                moved, last_period = await self.onec.get_moved_products(
+                    watermark - timedelta(seconds=settings.stock_incremental_overlap)
+                )
+            except Exception as e:
+                logger.error(f"Error reading stock movements from 1C: {e}")
+                return
+            
+            ref_keys = list(dict.fromkeys(moved + retry))
+            if not ref_keys:
+                return
+            stats = await self._sync_stock("incremental", self._iter_stock_balances_for(ref_keys), True, scoped=True)
+            if stats is None:
+                # Ошибка прогона: водяной знак не сдвигается, движения будут прочитаны снова
+                return
+            
+            state = {STOCK_RETRY_KEY: json.dumps(sorted(stats["failed_refs"]))}
+            if last_period and last_period > watermark:
+                state[STOCK_WATERMARK_KEY] = last_period.isoformat()
+            await self._save_state(state)
+            if stats["failed_refs"]:
+                logger.warning(f"{len(stats['failed_refs'])} products were not updated in Bitrix24, retrying on the next incremental run")
+    
+    async def _iter_stock_balances_for(self, ref_keys: List[str]) -> AsyncIterator[Dict]:
+        for item in await self.onec.get_stock_balances_for(ref_keys):
+            yield item
+    
+    async def _load_state(self, key: str) -> Optional[str]:
+        async with async_session_maker() as session:
+            return await session.scalar(select(SyncState.value).where(SyncState.key == key))
+    
+    async def _save_state(self, values: Dict[str, str]):
+        now = datetime.utcnow()
+        stmt = pg_insert(SyncState).values([{"key": key, "value": value, "updated_at": now} for key, value in values.items()])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[SyncState.key],
+            set_={"value": stmt.excluded.value, "updated_at": stmt.excluded.updated_at}
+        )
+        async with async_session_maker() as session:
+            await session.execute(stmt)
+            await session.commit()
+    
+    def _zero_items(self, seen: Set[str], last_quantities: Optional[Dict[str, int]]) -> List[Dict]:
+        """Нулевые остатки товаров, которых нет в выгрузке Balance
+
+        1С не возвращает в Balance товары с нулевым остатком, поэтому
+        распроданный товар нужно обнулить явно: все сопоставленные коды и
+        (в режиме delta) коды с ненулевым последним отправленным остатком.
+        """
+        codes = set(mapping_index.onec_codes())
+        if last_quantities is not None:
+            codes.update(code for code, quantity in last_quantities.items() if quantity)
+        items = []
+        for code in sorted(codes - seen):
+            mappings = mapping_index.by_onec(code)
+            items.append({
+                "product_code": code,
+                "product_name": mappings[0]["onec_product_name"] if mappings else "",
+                "quantity": 0
+            })
+        return items
+    
+    async def _sync_stock(self, mode: str, items: AsyncIterator[Dict], delta: bool, scoped: bool = False) -> Optional[Dict]:
+        """Отправить остатки из потока позиций; scoped — сравнивать с отправленными остатками только позиций пачки
+
+        Поток без scoped — вся выгрузка Balance: после неё товары, которых
+        в ней не было, отправляются с нулевым остатком.
+        Возвращает статистику прогона или None, если он прервался ошибкой.
+        """
+        logger.info(f"Starting {mode} stock synchronization from 1C to Bitrix24")
+        started = time.perf_counter()
         
         async with async_session_maker() as session:
             try:
-                stock_balances = await self.onec.get_stock_balances()
-                logger.info(f"Retrieved {len(stock_balances)} stock items from 1C")
+                await mapping_index.ensure_loaded()
+                last_quantities = await self._load_last_quantities(session) if delta and not scoped else None
+                total_items = 0
+                stats = {
+                    "updated": 0,
+                    "changed": 0,
+                    "skipped": 0,
+                    "failed_products": {},
+                    "failed_refs": set(),
+                    "snapshot_date": datetime.utcnow()
+                }
+                chunk = []
                 
-                # Сохраняем снимок остатков
-                for item in stock_balances:
-                    snapshot = StockSnapshot(
-                        product_code=item["product_code"],
-                        product_name=item["product_name"],
-                        quantity=item["quantity"],
-                        warehouse=item.get("warehouse", "Основной склад")
-                    )
-                    session.add(snapshot)
+                async def _push(chunk: List[Dict]):
+                    quantities = last_quantities
+                    if delta and scoped:
+                        quantities = await self._load_last_quantities(session, [item["product_code"] for item in chunk])
+                    await self._push_stock_chunk(session, chunk, stats, quantities)
                 
-                await session.commit()
+                seen = set()
+                async for item in items:
+                    total_items += 1
+                    seen.add(item["product_code"])
+                    chunk.append(item)
+                    if len(chunk) >= Bitrix24Client.BATCH_LIMIT:
+                        await _push(chunk)
+                        chunk = []
                 
-                # Обновляем остатки в Bitrix24
-                updated_count = 0
-                error_count = 0
+                if chunk:
+                    await _push(chunk)
                 
-                for item in stock_balances:
-                    try:
-                        stmt = select(ProductMapping).where(
-                            ProductMapping.onec_product_code == item["product_code"]
-                        )
-                        result = await session.execute(stmt)
-                        mapping = result.scalar_one_or_none()
-                        
-                        if mapping:
-                            success = await self.bitrix24.update_product_quantity(
-                                mapping.bitrix24_product_id,
-                                item["quantity"]
-                            )
-                            
-                            if success:
-                                updated_count += 1
-                            else:
-                                error_count += 1
-                        else:
-                            logger.warning(f"No mapping found for 1C product {item['product_code']}")
-                    
-                    except Exception as e:
-                        logger.error(f"Error updating product {item['product_code']}: {e}")
-                        error_count += 1
+                logger.info(f"Retrieved {total_items} stock items from 1C")
                 
-                # Логируем результат
-                log_entry = SyncLog(
-                    sync_type="stock_to_bitrix24",
-                    direction="1c_to_bitrix24",
-                    status="success" if error_count == 0 else "partial_success",
-                    request_data=json.dumps({"total_items": len(stock_balances)}),
-                    response_data=json.dumps({
-                        "updated": updated_count,
-                        "errors": error_count
-                    })
-                )
-                session.add(log_entry)
-                await session.commit()
+                zero_items = [] if scoped else self._zero_items(seen, last_quantities)
+                for start in range(0, len(zero_items), Bitrix24Client.BATCH_LIMIT):
+                    await _push(zero_items[start:start + Bitrix24Client.BATCH_LIMIT])
+                if zero_items:
+                    logger.info(f"{len(zero_items)} products are missing from 1C Balance, pushing zero stock")
+                updated_count = stats["updated"]
+                error_count = len(stats["failed_products"])
+                
+                # Логируем результат (инкрементальный прогон — только если что-то изменилось)
+                status = "success" if error_count == 0 else "partial_success"
+                if mode != "incremental" or stats["changed"] or error_count:
+                    sync_log_writer.add(
+                        sync_type="stock_to_bitrix24",
+                        direction="1c_to_bitrix24",
+                        status=status,
+                        request_data={"total_items": total_items, "zero_items": len(zero_items), "mode": mode},
+                        response_data={
+                            "updated": updated_count,
+                            "changed": stats["changed"],
+                            "skipped": stats["skipped"],
+                            "errors": error_count,
+                            "failed_products": stats["failed_products"]
+                        }
+                    )
                 
-                logger.info(f"Stock sync completed. Updated: {updated_count}, Errors: {error_count}")
+                STOCK_SYNC_DURATION.labels(mode, status).observe(time.perf_counter() - started)
+                STOCK_SYNC_ITEMS.labels("received").inc(total_items)
+                STOCK_SYNC_ITEMS.labels("changed").inc(stats["changed"])
+                STOCK_SYNC_ITEMS.labels("skipped").inc(stats["skipped"])
+                STOCK_SYNC_ITEMS.labels("updated").inc(updated_count)
+                STOCK_SYNC_ITEMS.labels("failed").inc(error_count)
+                STOCK_SYNC_LAST_SUCCESS.set_to_current_time()
+                
+                logger.info(
+                    f"Stock sync completed. Updated: {updated_count}, Changed: {stats['changed']}, "
+                    f"Skipped: {stats['skipped']}, Errors: {error_count}"
+                )
+                return stats
             
             except Exception as e:
                 logger.error(f"Error during stock synchronization: {e}")
+                STOCK_SYNC_DURATION.labels(mode, "error").observe(time.perf_counter() - started)
                 
-                log_entry = SyncLog(
+                await session.rollback()
+                sync_log_writer.add(
                     sync_type="stock_to_bitrix24",
                     direction="1c_to_bitrix24",
                     status="error",
                     error_message=str(e)
                 )
-                session.add(log_entry)
-                await session.commit()
+                return None
@@ -1,6 +1,7 @@
 """Telegram бот для уведомлений и команд"""
 import httpx
 from loguru import logger
+from http_clients import http_clients
 
 
 class TelegramBot:
@@ -10,7 +11,9 @@ class TelegramBot:
         self.token = token
         self.chat_id = chat_id
         self.api_url = f"https://api.telegram.org/bot{token}"
-        self.client = httpx.AsyncClient(timeout=30.0)
+        shared = http_clients.get("telegram")
+        self._owns_client = shared is None
+        self.client = shared or httpx.AsyncClient(timeout=30.0)
     
     async def send_message(self, text: str, chat_id: str = None):
         """Отправить сообщение"""
@@ -63,4 +66,5 @@ class TelegramBot:
         await self.send_message(message)
     
     async def close(self):
-        await self.client.aclose()
+        if self._owns_client:
+            await self.client.aclose()
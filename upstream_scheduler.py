@@ -0,0 +1,282 @@
+"""Планировщик исходящих запросов к внешним сервисам
+
+Один экземпляр на сервис, встроен в транспорт общего пула соединений:
+- маркерная корзина по лимитам Bitrix24;
+- адаптивный (AIMD) лимит параллельных запросов к 1С по наблюдаемой задержке;
+- повтор с экспоненциальной задержкой и джиттером для безопасных к повтору ошибок;
+- автомат отключения (circuit breaker), быстро отказывающий, пока сервис недоступен.
+"""
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+import httpx
+from loguru import logger
+from config import settings
+from metrics import UPSTREAM_RETRIES, UPSTREAM_CIRCUIT_OPEN, UPSTREAM_CONCURRENCY_LIMIT
+
+
+# Методы, которые можно повторить после таймаута или 5xx: запрос мог быть уже выполнен
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+# Статусы «сервер отказался выполнять запрос»: повтор безопасен для любого метода
+REJECTED_STATUSES = {429, 503}
+
+
+class CircuitOpenError(httpx.TransportError):
+    """Сервис временно считается недоступным, запрос не отправлялся"""
+
+
+class QueueTimeoutError(httpx.PoolTimeout):
+    """Не дождались свободного слота адаптивного лимита, запрос не отправлялся"""
+
+
+class TokenBucket:
+    """Маркерная корзина: rate запросов в секунду, не больше burst подряд
+
+    Корзина своя в каждом процессе: при нескольких процессах rate и burst
+    делятся на их число (settings.app_processes).
+    """
+    
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+    
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+    
+    def drain(self):
+        """Сервис сообщил о превышении лимита: обнулить запас"""
+        self._tokens = min(self._tokens, 0.0)
+        self._updated_at = time.monotonic()
+
+
+class AIMDLimiter:
+    """Адаптивный лимит параллельных запросов
+
+    Пока задержка ниже целевой, лимит растёт примерно на 1 за «окно» запросов;
+    при превышении задержки или ошибке сервера уменьшается вдвое (не чаще раза за target).
+    """
+    
+    def __init__(self, name: str, initial: int, minimum: int, maximum: int, latency_target: float):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.limit = float(initial)
+        self._in_flight = 0
+        self._decreased_at = 0.0
+        self._condition = asyncio.Condition()
+        UPSTREAM_CONCURRENCY_LIMIT.labels(name).set(self.limit)
+    
+    async def acquire(self, timeout: float) -> bool:
+        """Занять слот; False, если он не освободился за timeout"""
+        async with self._condition:
+            try:
+                await asyncio.wait_for(
+                    self._condition.wait_for(lambda: self._in_flight < int(self.limit)),
+                    timeout
+                )
+            except asyncio.TimeoutError:
+                return False
+            self._in_flight += 1
+            return True
+    
+    async def cancel(self):
+        """Вернуть слот, запрос по которому не отправлялся (лимит не меняется)"""
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+    
+    async def release(self, latency: float, overloaded: bool):
+        async with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if overloaded or latency > self.latency_target:
+                if now - self._decreased_at > self.latency_target:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._decreased_at = now
+                    logger.warning(f"{self.name} concurrency limit decreased to {int(self.limit)} (latency {latency:.2f}s)")
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            UPSTREAM_CONCURRENCY_LIMIT.labels(self.name).set(self.limit)
+            self._condition.notify_all()
+
+
+class CircuitBreaker:
+    """closed -> open после failure_threshold ошибок подряд -> half-open через reset_timeout"""
+    
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_at: Optional[float] = None
+    
+    def is_open(self) -> bool:
+        """Отказывает ли автомат сейчас (без захвата пробного запроса half-open)"""
+        return self._opened_at is not None and time.monotonic() - self._opened_at < self.reset_timeout
+    
+    def allow(self) -> bool:
+        if self._opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self._opened_at < self.reset_timeout:
+            return False
+        # half-open: один пробный запрос; зависший пробный не блокирует дольше reset_timeout
+        if self._probe_at is not None and now - self._probe_at < self.reset_timeout:
+            return False
+        self._probe_at = now
+        return True
+    
+    def record_success(self):
+        if self._opened_at is not None:
+            logger.info(f"{self.name} circuit closed")
+            UPSTREAM_CIRCUIT_OPEN.labels(self.name).set(0)
+        self._failures = 0
+        self._opened_at = None
+        self._probe_at = None
+    
+    def record_failure(self):
+        self._failures += 1
+        self._probe_at = None
+        if self._opened_at is not None or self._failures >= self.failure_threshold:
+            if self._opened_at is None:
+                logger.error(f"{self.name} circuit opened after {self._failures} consecutive failures")
+            self._opened_at = time.monotonic()
+            UPSTREAM_CIRCUIT_OPEN.labels(self.name).set(1)
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class ScheduledTransport(httpx.AsyncBaseTransport):
+    """Транспорт, пропускающий запросы к сервису через планировщик"""
+    
+    def __init__(
+        self,
+        name: str,
+        transport: httpx.AsyncBaseTransport,
+        bucket: TokenBucket = None,
+        limiter: AIMDLimiter = None
+    ):
+        self.name = name
+        self._transport = transport
+        self.bucket = bucket
+        self.limiter = limiter
+        self.breaker = CircuitBreaker(name, settings.circuit_failure_threshold, settings.circuit_reset_timeout)
+    
+    def _backoff(self, attempt: int) -> float:
+        """Полный джиттер: случайная пауза до base * 2^attempt"""
+        return random.uniform(0, min(settings.upstream_backoff_max, settings.upstream_backoff_base * 2 ** attempt))
+    
+    async def _rate_limited(self, response: httpx.Response) -> bool:
+        """429 или QUERY_LIMIT_EXCEEDED от Bitrix24 (приходит с кодом 503)"""
+        if response.status_code == 429:
+            return True
+        if response.status_code == 503 and self.bucket:
+            await response.aread()
+            return b"QUERY_LIMIT_EXCEEDED" in response.content
+        return False
+    
+    async def _send(self, request: httpx.Request) -> httpx.Response:
+        if self.bucket:
+            await self.bucket.acquire()
+        if not self.limiter:
+            return await self._transport.handle_async_request(request)
+        
+        if not await self.limiter.acquire(settings.upstream_queue_timeout):
+            raise QueueTimeoutError(f"{self.name} concurrency limit wait timed out, request not sent", request=request)
+        # Пока запрос ждал слота, автомат мог открыться: ожидающие тоже получают отказ
+        if self.breaker.is_open():
+            await self.limiter.cancel()
+            raise CircuitOpenError(f"{self.name} is unavailable, request not sent", request=request)
+        started = time.monotonic()
+        overloaded = True
+        try:
+            response = await self._transport.handle_async_request(request)
+            overloaded = response.status_code >= 500 or response.status_code == 429
+            return response
+        finally:
+            await self.limiter.release(time.monotonic() - started, overloaded)
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        idempotent = request.method in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"{self.name} is unavailable, request not sent", request=request)
+            
+            delay = None
+            try:
+                response = await self._send(request)
+            except (QueueTimeoutError, CircuitOpenError):
+                # Сервис перегружен или недоступен: отказать сразу, не вставая в очередь снова
+                raise
+            except httpx.PoolTimeout as e:
+                # Нет свободного соединения в своём пуле: сервис тут ни при чём
+                error = e
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                # Запрос не ушёл на сервер
+                self.breaker.record_failure()
+                error = e
+            except httpx.TransportError as e:
+                # Таймаут чтения или обрыв: запрос мог быть выполнен
+                self.breaker.record_failure()
+                if not idempotent:
+                    raise
+                error = e
+            else:
+                if await self._rate_limited(response):
+                    # Сервис жив, но просит сбавить темп
+                    self.breaker.record_success()
+                    if self.bucket:
+                        self.bucket.drain()
+                    delay = _retry_after(response)
+                elif response.status_code >= 500:
+                    self.breaker.record_failure()
+                    if not idempotent and response.status_code not in REJECTED_STATUSES:
+                        return response
+                else:
+                    self.breaker.record_success()
+                    return response
+                error = None
+                if attempt >= settings.upstream_max_retries:
+                    return response
+                await response.aclose()
+            
+            if error is not None and attempt >= settings.upstream_max_retries:
+                raise error
+            
+            attempt += 1
+            delay = delay if delay is not None else self._backoff(attempt)
+            UPSTREAM_RETRIES.labels(self.name).inc()
+            logger.warning(f"Retrying {request.method} {self.name} request in {delay:.1f}s (attempt {attempt})")
+            await asyncio.sleep(delay)
+    
+    async def aclose(self):
+        await self._transport.aclose()